@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Compare the shlex based parsing and str.format based formatting of record
+content, as done before octodns_lexicon.ContentCodec, against the codecs.
+
+    python benchmarks/bench_codec.py [--records 100000] [--repeat 3]
+"""
+
+import argparse
+import random
+import shlex
+import sys
+import timeit
+from collections import namedtuple
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from octodns_lexicon import CONTENT_CODECS  # noqa: E402
+
+Mx = namedtuple('Mx', 'preference exchange')
+Srv = namedtuple('Srv', 'priority weight port target')
+Caa = namedtuple('Caa', 'flags tag value')
+
+SHLEX_FIELDS = {
+    'CAA': ('flags', 'tag', 'value'),
+    'MX': ('priority', 'exchange'),
+    'SRV': ('priority', 'weight', 'port', 'target'),
+}
+
+SHLEX_TEMPLATES = {
+    'CAA': ('{} {} "{}"', ('flags', 'tag', 'value')),
+    'MX': ('{} {}', ('preference', 'exchange')),
+    'SRV': ('{} {} {} {}', ('priority', 'weight', 'port', 'target')),
+}
+
+
+def fixtures(count, seed=0):
+    rand = random.Random(seed)
+    contents = {'CAA': [], 'MX': [], 'SRV': []}
+    values = {'CAA': [], 'MX': [], 'SRV': []}
+    for i in range(count):
+        rtype = rand.choice(('CAA', 'MX', 'MX', 'SRV', 'SRV'))
+        host = 'host{}.example.com.'.format(i)
+        if rtype == 'MX':
+            value = Mx(rand.randint(0, 50), host)
+            contents[rtype].append('{} {}'.format(*value))
+        elif rtype == 'SRV':
+            value = Srv(rand.randint(0, 10), rand.randint(0, 10),
+                        rand.randint(1, 65535), host)
+            contents[rtype].append('{} {} {} {}'.format(*value))
+        else:
+            value = Caa(0, rand.choice(('issue', 'issuewild')),
+                        'ca{}.example.net'.format(i))
+            contents[rtype].append('{} {} "{}"'.format(*value))
+        values[rtype].append(value)
+    return contents, values
+
+
+def parse_shlex(contents):
+    return {rtype: [dict(zip(SHLEX_FIELDS[rtype], shlex.split(c)))
+                    for c in items]
+            for rtype, items in contents.items()}
+
+
+def parse_codec(contents):
+    return {rtype: CONTENT_CODECS[rtype].parse_all(items)
+            for rtype, items in contents.items()}
+
+
+def format_str(values):
+    out = {}
+    for rtype, items in values.items():
+        template, attrs = SHLEX_TEMPLATES[rtype]
+        out[rtype] = [template.format(*[getattr(v, a) for a in attrs])
+                      for v in items]
+    return out
+
+
+def format_codec(values):
+    return {rtype: CONTENT_CODECS[rtype].format_all(items)
+            for rtype, items in values.items()}
+
+
+def best_of(func, arg, repeat):
+    return min(timeit.repeat(lambda: func(arg), number=1, repeat=repeat))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    contents, values = fixtures(args.records)
+    if parse_shlex(contents) != parse_codec(contents) or \
+            format_str(values) != format_codec(values):
+        print('codec and shlex results differ', file=sys.stderr)
+        return 1
+
+    for label, old, new, arg in (
+            ('parse', parse_shlex, parse_codec, contents),
+            ('format', format_str, format_codec, values)):
+        old_time = best_of(old, arg, args.repeat)
+        new_time = best_of(new, arg, args.repeat)
+        print('{:<7} {:>8} records: shlex/str {:.3f}s, codec {:.3f}s, '
+              '{:.1f}x'.format(label, args.records, old_time, new_time,
+                               old_time / new_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Measure what importing octodns_lexicon adds to the startup of octoDNS, with
+python -X importtime, once octoDNS itself is loaded.
+
+    python benchmarks/bench_import.py [--repeat 10]
+        [--save benchmarks/import_baseline.json]
+        [--check benchmarks/import_baseline.json] [--threshold 0.5]
+
+Importing octodns_lexicon must not load lexicon, or any of the modules
+which it only needs once a zone is handled: the run fails if it does.
+--save writes the result as a JSON baseline. --check compares the result
+with a baseline, and exits non zero if the import got slower by more than
+--threshold (a fraction).
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from os.path import abspath, dirname
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+# loaded by octoDNS before it gets to the providers
+PRELOADED = ('octodns.manager', 'octodns.provider.base', 'octodns.record',
+             'octodns.zone')
+
+DEFERRED = ('lexicon', 'requests', 'asyncio', 'sqlite3', 'multiprocessing')
+
+SCRIPT = '''
+import sys
+import {preloaded}
+import octodns_lexicon
+print(','.join(m for m in {deferred!r} if m in sys.modules))
+'''.format(preloaded=', '.join(PRELOADED), deferred=DEFERRED)
+
+
+def measure():
+    """One import, in a fresh interpreter.
+
+        :type return: (microseconds, modules loaded which should not be)
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    # byte code is cached, as it would be for an installed package
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    done = subprocess.run([sys.executable, '-X', 'importtime', '-c', SCRIPT],
+                          env=env, cwd=ROOT, capture_output=True, text=True,
+                          check=True)
+    micros = None
+    for line in done.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == 'octodns_lexicon':
+            micros = int(fields[1])
+    loaded = [m for m in done.stdout.strip().split(',') if m]
+    return micros, loaded
+
+
+def check(result, baseline, threshold):
+    failures = []
+    if result['loaded']:
+        failures.append('import loads {}'.format(
+            ', '.join(result['loaded'])))
+    if result['micros'] > baseline['micros'] * (1 + threshold):
+        failures.append('import: {}us > {}us'.format(result['micros'],
+                                                     baseline['micros']))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--save', metavar='BASELINE')
+    parser.add_argument('--check', metavar='BASELINE')
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='keep the best time of this many runs')
+    args = parser.parse_args(argv)
+
+    # a first run to write the byte code
+    measure()
+    runs = [measure() for _ in range(args.repeat)]
+    result = {'micros': min(micros for micros, _ in runs),
+              'loaded': runs[0][1]}
+    print('import octodns_lexicon: {}us, deferred modules loaded: {}'.format(
+        result['micros'], ', '.join(result['loaded']) or 'none'))
+
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(result, fh, indent=2, sort_keys=True)
+
+    failures = check(result, {'micros': float('inf')}, args.threshold)
+    if args.check:
+        with open(args.check) as fh:
+            failures = check(result, json.load(fh), args.threshold)
+    for failure in failures:
+        print('REGRESSION ' + failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
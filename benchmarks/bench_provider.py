@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Benchmark LexiconProvider.populate, rrset computation, plan diffing and
+_apply on synthetic zones, against an in-process counting provider.
+
+    python benchmarks/bench_provider.py [--sizes 1000 10000 100000]
+        [--save benchmarks/baseline.json]
+        [--check benchmarks/baseline.json] [--threshold 0.25] [--repeat 3]
+
+--save writes the results as a JSON baseline. --check compares the results
+with a baseline, and exits non zero if any phase got slower by more than
+--threshold (a fraction), or if _apply issued more provider calls.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from collections import Counter
+from os.path import abspath, dirname
+from types import SimpleNamespace
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from octodns.provider.plan import Plan  # noqa: E402
+from octodns.zone import Zone  # noqa: E402
+
+from octodns_lexicon import LexiconProvider, \
+    OnTheFlyLexiconConfigSource  # noqa: E402
+
+ZONE_NAME = 'bench.example.com.'
+
+# (type, weight, max number of values)
+TYPE_MIX = (('A', 30, 4), ('AAAA', 10, 2), ('TXT', 15, 3), ('CNAME', 15, 1),
+            ('MX', 10, 3), ('SRV', 10, 3), ('CAA', 10, 2))
+
+
+def _content(rand, rtype, i, j):
+    if rtype == 'A':
+        return '10.{}.{}.{}'.format(i // 65536 % 256, i // 256 % 256, j)
+    elif rtype == 'AAAA':
+        return '2001:db8:{:x}:{:x}::{:x}'.format(i // 65536 % 65536,
+                                                 i % 65536, j)
+    elif rtype == 'TXT':
+        return 'v=bench{} value {}'.format(i, j)
+    elif rtype == 'CNAME':
+        return 'target{}.example.net.'.format(i)
+    elif rtype == 'MX':
+        return '{} mx{}.example.net.'.format(10 * (j + 1), i)
+    elif rtype == 'SRV':
+        return '{} {} {} srv{}-{}.example.net.'.format(
+            j, rand.randint(0, 10), rand.randint(1, 65535), i, j)
+    return '0 {} "ca{}.example.org"'.format(
+        ('issue', 'issuewild')[j % 2], i)
+
+
+def generate_listing(size, seed=0):
+    """A lexicon listing of about size records, with a realistic mix of
+    types and multi value records."""
+    rand = random.Random(seed)
+    types, weights, _ = zip(*TYPE_MIX)
+    max_values = {rtype: n for rtype, _, n in TYPE_MIX}
+    listing = []
+    i = 0
+    while len(listing) < size:
+        rtype = rand.choices(types, weights)[0]
+        name = ('_sip._tcp.host{}' if rtype == 'SRV' else 'host{}').format(i)
+        ttl = rand.choice((300, 3600, 86400))
+        for j in range(rand.randint(1, max_values[rtype])):
+            listing.append({'type': rtype, 'name': name + '.' + ZONE_NAME[:-1],
+                            'ttl': ttl, 'content': _content(rand, rtype, i, j),
+                            'id': '{}-{}'.format(i, j)})
+        i += 1
+    return listing
+
+
+def mutate_listing(listing, seed=1, ratio=0.1):
+    """The desired state: about ratio of the rrsets get a changed value, a
+    changed ttl, or are removed, and as many new rrsets are added."""
+    rand = random.Random(seed)
+    by_rrset = {}
+    for record in listing:
+        by_rrset.setdefault((record['name'], record['type']), []).append(
+            dict(record))
+    desired = []
+    for n, ((name, rtype), records) in enumerate(by_rrset.items()):
+        roll = rand.random()
+        if roll < ratio / 3:
+            for record in records:
+                record['ttl'] += 60
+        elif roll < ratio * 2 / 3 and rtype not in ('CNAME', 'SRV'):
+            records[-1]['content'] = _content(rand, rtype, n + 10 ** 7, 9)
+        elif roll < ratio:
+            continue
+        desired.extend(records)
+    extra = generate_listing(int(len(listing) * ratio), seed=seed)
+    for record in extra:
+        record['name'] = record['name'].replace('host', 'newhost')
+    return desired + extra
+
+
+class CountingProvider:
+    """Stands in for a lexicon provider, and counts the calls made."""
+
+    def __init__(self, listing):
+        self.listing = listing
+        self.calls = Counter()
+
+    def authenticate(self):
+        self.calls['authenticate'] += 1
+
+    def list_records(self, rtype=None, name=None, content=None):
+        self.calls['list_records'] += 1
+        return [dict(r) for r in self.listing]
+
+    def create_record(self, rtype, name, content):
+        self.calls['create_record'] += 1
+        return True
+
+    def update_record(self, identifier, rtype, name, content):
+        self.calls['update_record'] += 1
+        return True
+
+    def delete_record(self, identifier=None, rtype=None, name=None,
+                      content=None):
+        self.calls['delete_record'] += 1
+        return True
+
+
+def _provider(listing):
+    provider = LexiconProvider('bench', {'provider_name': 'bench'})
+    lexicon_provider = CountingProvider(listing)
+    provider._create_client = lambda zone_name: (
+        SimpleNamespace(provider=lexicon_provider),
+        OnTheFlyLexiconConfigSource(zone_name))
+    return provider, lexicon_provider
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def run(size):
+    listing = generate_listing(size)
+    provider, lexicon_provider = _provider(listing)
+    results = {'records': len(listing)}
+
+    existing = Zone(ZONE_NAME, [])
+    _, results['populate'] = _timed(provider.populate, existing)
+
+    def rrsets(zone):
+        return sum(len(getattr(provider, '_rrset_for_' + r._type)(r))
+                   for r in zone.records)
+
+    _, results['rrsets'] = _timed(rrsets, existing)
+
+    desired_provider, _ = _provider(mutate_listing(listing))
+    desired = Zone(ZONE_NAME, [])
+    desired_provider.populate(desired)
+    changes, results['plan'] = _timed(existing.changes, desired, provider)
+
+    lexicon_provider.calls.clear()
+    plan = Plan(existing, desired, changes, True)
+    _, results['apply'] = _timed(provider._apply, plan)
+    results['changes'] = len(changes)
+    results['apply_calls'] = dict(lexicon_provider.calls)
+    return results
+
+
+def check(results, baseline, threshold):
+    failures = []
+    for size, result in results.items():
+        if size not in baseline:
+            continue
+        base = baseline[size]
+        for phase in ('populate', 'rrsets', 'plan', 'apply'):
+            if result[phase] > base[phase] * (1 + threshold):
+                failures.append('{} records, {}: {:.3f}s > {:.3f}s'.format(
+                    size, phase, result[phase], base[phase]))
+        if sum(result['apply_calls'].values()) > \
+                sum(base['apply_calls'].values()):
+            failures.append('{} records, apply calls: {} > {}'.format(
+                size, result['apply_calls'], base['apply_calls']))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--save', metavar='BASELINE')
+    parser.add_argument('--check', metavar='BASELINE')
+    parser.add_argument('--threshold', type=float, default=0.25)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='keep the best time of this many runs')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for size in args.sizes:
+        runs = [run(size) for _ in range(args.repeat)]
+        result = results[str(size)] = runs[0]
+        for phase in ('populate', 'rrsets', 'plan', 'apply'):
+            result[phase] = min(r[phase] for r in runs)
+        print('{:>7} records, {:>6} changes: populate {:.3f}s, rrsets '
+              '{:.3f}s, plan {:.3f}s, apply {:.3f}s, calls {}'.format(
+                  result['records'], result['changes'], result['populate'],
+                  result['rrsets'], result['plan'], result['apply'],
+                  result['apply_calls']))
+
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+
+    if args.check:
+        with open(args.check) as fh:
+            failures = check(results, json.load(fh), args.threshold)
+        for failure in failures:
+            print('REGRESSION ' + failure, file=sys.stderr)
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,19 +3,32 @@
 #
 
 
+import hashlib
+import heapq
+import json
 import logging
+import os
+import random
 import shlex
 import re
-from threading import Lock
-
-from collections import defaultdict, namedtuple
-
-from lexicon.client import Client as LexiconClient
-from lexicon.config import ConfigResolver as LexiconConfigResolver, \
-    ConfigSource as LexiconConfigSource
+import sys
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, FIRST_EXCEPTION, \
+    BrokenExecutor, CancelledError, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from importlib import import_module
+from threading import Condition, Event, Lock, get_ident, local
+
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from itertools import groupby
+from operator import attrgetter
 
 from octodns.provider.base import BaseProvider
 from octodns.record import Record
+from octodns.zone import Zone
 
 __version__ = "0.1.dev4"
 
@@ -26,6 +39,54 @@ def _lexicon_fqdn(octodns_record):
     return octodns_record.fqdn
 
 
+_MUTATIONS = frozenset(('create_record', 'update_record', 'delete_record'))
+# The actions whose GETs may be served from the HTTP cache: those of the
+# others, eg a job polled until it is done, must reach the API every time
+_CACHED_ACTIONS = frozenset(('authenticate', 'list_records'))
+
+
+def _status_code(exception):
+    response = getattr(exception, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+def _unescaped(content):
+    # as listed, ie without the escaping of octodns
+    return content.replace('\\;', ';')
+
+
+def _same_ttl(lexicon_record, ttl):
+    try:
+        return int(lexicon_record['ttl']) == int(ttl)
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def _is_auth_error(exception):
+    return _status_code(exception) in (401, 403)
+
+
+def _is_transient_error(exception):
+    status_code = _status_code(exception)
+    if status_code is None:
+        # connection errors, timeouts and the like
+        return isinstance(exception, OSError)
+    return status_code == 429 or status_code >= 500
+
+
+def _consume(listing):
+    # Hand out the records of listing one by one, dropping the reference
+    # held by the listing itself, so that each raw record can be freed as
+    # soon as it has been grouped.
+    if isinstance(listing, list):
+        for i in range(len(listing)):
+            lexicon_record, listing[i] = listing[i], None
+            yield lexicon_record
+        listing.clear()
+    else:
+        yield from listing
+
+
 def _octodns_name(lexicon_record):
     name = lexicon_record['name']
     if name.startswith('@.'):
@@ -35,6 +96,130 @@ def _octodns_name(lexicon_record):
     return name
 
 
+def _zone_relative_name(name, zone_name):
+    if name.endswith(zone_name):
+        # This should be handled in the various Lexicon providers.
+        # However, there is no harm in doing some extra check for it
+        # here - just in case.
+        name = name.rstrip('.')
+    if name.endswith(zone_name[:-1]):
+        return name[:-(len(zone_name))]
+    return name
+
+
+def _last_token(content):
+    match = _LAST_TOKEN(content)
+    return match.group(1) if match else shlex.split(content)[-1]
+
+
+class ContentCodec:
+    """Parses and formats the content of one type of lexicon record.
+
+    Lexicon records with more than one data field, such as MX or SRV, keep
+    them space separated in their content. Plain content is parsed with a
+    precompiled regex, and only content with quotes or escapes which the
+    regex does not handle falls back to shlex, which is a lot slower.
+    """
+
+    def __init__(self, fields, attrs, template, pattern):
+        self.fields = fields
+        self.attrs = attrs
+        self.template = template
+        self._match = re.compile(pattern).match
+
+    def parse(self, content):
+        match = self._match(content)
+        if match:
+            tokens = [t for t in match.groups() if t is not None]
+        else:
+            tokens = shlex.split(content)
+        if len(tokens) != len(self.fields):
+            raise ValueError('unable to parse {!r} into {}'.format(
+                content, ', '.join(self.fields)))
+        return dict(zip(self.fields, tokens))
+
+    def parse_all(self, contents):
+        return [self.parse(content) for content in contents]
+
+    def format_all(self, values):
+        template = self.template.format
+        getter = attrgetter(*self.attrs)
+        return [template(*getter(value)) for value in values]
+
+
+# one token, as long as it is neither quoted nor escaped, and whitespace as
+# shlex sees it
+_TOKEN = r'([^ \t\r\n"\'\\]+)'
+_WS = r'[ \t\r\n]'
+_LAST_TOKEN = re.compile(r'{}{}*$'.format(_TOKEN, _WS)).search
+
+CONTENT_CODECS = {
+    'CAA': ContentCodec(
+        ('flags', 'tag', 'value'), ('flags', 'tag', 'value'),
+        '{} {} "{}"',
+        r'{1}*{0}{1}+{0}{1}+(?:"([^"\\]*)"|{0}){1}*$'.format(_TOKEN, _WS)),
+    'MX': ContentCodec(
+        ('priority', 'exchange'), ('preference', 'exchange'),
+        '{} {}',
+        r'{1}*{0}{1}+{0}{1}*$'.format(_TOKEN, _WS)),
+    'SRV': ContentCodec(
+        ('priority', 'weight', 'port', 'target'),
+        ('priority', 'weight', 'port', 'target'),
+        '{} {} {} {}',
+        r'{1}*{0}{1}+{0}{1}+{0}{1}+{0}{1}*$'.format(_TOKEN, _WS)),
+}
+
+
+BULK_ADAPTERS = {}
+
+
+def register_bulk_adapter(provider_name):
+    """Class decorator registering a BulkAdapter for lexicon provider_name.
+    """
+    def register(adapter_class):
+        BULK_ADAPTERS[provider_name] = adapter_class()
+        return adapter_class
+    return register
+
+
+class BulkAdapter(ABC):
+    """Batch path to a DNS API, beyond what lexicon offers.
+
+    Lexicon only handles one value at a time, while many APIs replace whole
+    rrsets in one request. Adapters, registered per lexicon provider_name
+    with register_bulk_adapter, let LexiconProvider use those requests.
+    """
+
+    def supports(self, provider):
+        """Whether this lexicon provider instance can be used in bulk."""
+        return True
+
+    @abstractmethod
+    def replace_rrset(self, provider, rtype, name, content, ttl):
+        """Replace the rrset of rtype and name with the values in content,
+        or delete it, if content is empty. Returns a truthy value on
+        success."""
+
+
+@register_bulk_adapter('gandi')
+class GandiBulkAdapter(BulkAdapter):
+
+    def supports(self, provider):
+        return getattr(provider, 'protocol', None) == 'rest'
+
+    def replace_rrset(self, provider, rtype, name, content, ttl):
+        url = '/domains/{}/records/{}/{}'.format(
+            provider.domain_id, provider._relative_name(name), rtype)
+        if not content:
+            provider._delete(url)
+        else:
+            # Gandi's minimum TTL is 300, which lexicon's create_record
+            # raises lower TTLs to as well
+            provider._put(url, {'rrset_values': list(content),
+                                'rrset_ttl': max(ttl, 300)})
+        return True
+
+
 class LexiconProvider(BaseProvider):
     """
     Wrapper to handle LexiconProviders in octodns
@@ -45,9 +230,141 @@ class LexiconProvider(BaseProvider):
         supports: list of record types to support (A, AAAA, CNAME ...)
                 intersects with:
                     LexiconProvider.IMPLEMENTED
+                Populate only lists the supported types when they are
+                fewer than those implemented.
 
         lexicon_config: lexicon config
 
+        populate_spill_threshold: number of listed records to hold in
+                memory while populating, beyond which they are spilled to a
+                temporary file (default: no limit)
+
+        name_scopes: names of the records, relative to the zone, to manage
+                (default: all). Only these names are listed by populate,
+                and records of other names are left out of plans.
+
+        populate_max_workers: number of listings made concurrently by
+                populate, when it lists one slice per record type or name
+                (default: 4)
+
+        max_workers: number of changes to apply concurrently (default: 1)
+                Operations for one record are always applied in order,
+                only independent records are applied in parallel.
+
+        client_cache_size: number of authenticated lexicon clients to keep
+                around, so that populate and _apply can reuse them
+                (default: 32, 0 disables the cache)
+
+        client_cache_expiry: seconds after which an unused cached client is
+                discarded and authenticated anew (default: 900)
+
+        rate_limit: max number of lexicon provider calls per second
+                (default: unlimited). The limit is shared between all zones
+                and providers using the same lexicon_config, rate_limit
+                and rate_limit_burst.
+
+        rate_limit_burst: number of calls which may be made in a burst
+                before rate_limit kicks in (default: rate_limit)
+
+        adaptive_concurrency: max number of lexicon provider calls in
+                flight at once (default: none). The number actually allowed
+                starts at max_workers, grows while calls are fast and
+                succeed, and is cut on 429s, server errors and timeouts.
+                It is shared between all zones and providers using the same
+                lexicon_config, adaptive_concurrency and
+                adaptive_latency_tolerance. The worker pools of populate
+                and _apply are sized to this max.
+
+        adaptive_latency_tolerance: how many times slower than the fastest
+                seen a call may be, for the same action, and still count as
+                healthy (default: 2)
+
+        retries: number of times a failed create, update or delete is
+                retried (default: 0). Only server errors, 429s, connection
+                errors and falsy returns are retried.
+
+        retry_backoff: base delay in seconds of the jittered exponential
+                backoff between retries (default: 1)
+
+        retry_max_backoff: max delay in seconds between retries (default: 30)
+
+        retry_budget: max seconds spent on one operation, retries
+                included (default: 300)
+
+        metrics_textfile: path of a file to write metrics of the provider
+                calls to, in the prometheus text format, after each
+                populate and _apply (default: none)
+
+        metrics_callback: callable, or "module:function" string, which is
+                called with a dict describing each provider call, as it
+                completes. Its errors are logged and otherwise ignored
+                (default: none)
+
+        trace_file: path of a file to write spans around the phases of
+                populate and _apply to, in the Chrome trace event format,
+                appending the spans of each populate and _apply as it ends
+                (default: none). It can be opened in chrome://tracing or
+                Perfetto.
+
+        trace_hook: callable, or "module:function" string, called with the
+                name of each span and its attributes as keyword argument,
+                which returns a context manager to wrap the phase with
+                (default: none). OpenTelemetry's
+                tracer.start_as_current_span fits.
+
+        bulk_operations: whether to use the bulk adapter registered for
+                the provider_name, if any, to replace whole rrsets in one
+                call when that is cheaper (default: true)
+
+        max_api_calls: max number of provider calls a single _apply may
+                make. Plans needing more fail before anything is changed
+                (default: unlimited)
+
+        snapshot_cache: path of a sqlite file in which listed zones are
+                kept, so that populate can skip list_records while they
+                are fresh (default: none). Snapshots are updated by
+                successful _apply runs, and dropped when a change fails.
+
+        snapshot_ttl: seconds during which a snapshot is fresh
+                (default: 300)
+
+        journal_dir: directory in which _apply journals the operations it
+                starts and completes (default: none). Applying the same
+                operations again skips those done, and a snapshot is
+                brought up to date by listing only the rrsets touched,
+                rather than dropped, when an _apply is interrupted.
+
+        zone_state_ttl: seconds during which the records of a zone, once
+                listed, are kept in memory and populate is served from
+                there (default: none). Successful _apply runs update the
+                state kept, listing the rrsets in which they created values
+                so that their new ids are remembered.
+
+        http_pool_size: number of keep-alive connections kept per host in
+                the HTTP session shared by every zone, for lexicon providers
+                using the requests module functions (default: 10, 0 lets
+                every request open a connection of its own)
+
+        http_timeout: seconds after which HTTP requests made through the
+                shared session time out, unless the lexicon provider sets
+                a timeout itself (default: 60)
+
+        http_compression: whether to accept compressed HTTP responses
+                (default: true)
+
+        http_cache: whether to keep the responses to the GET requests
+                made through the shared session by authenticate and
+                list_records for the rest of the run, and serve them again,
+                conditionally where the API supports it. The cache is
+                emptied by every change made (default: false)
+
+        async_max_workers: number of threads running the blocking lexicon
+                calls of async_populate and async_apply (default: 4)
+
+        simulate: if set, an in-memory SimulatedProvider is used instead of
+                the lexicon provider, configured by this dict. See
+                SimulatedProvider for its options.
+
     Configuration added to the lexicon_config block will be injected as a
     lexicon DictConfigSource. Further config sources read are the env config
     source.
@@ -82,7 +399,21 @@ class LexiconProvider(BaseProvider):
     SUPPORTS_GEO = False
     SUPPORTS_DYNAMIC = False
 
-    def __init__(self, id, lexicon_config, supports=None, **kwargs):
+    def __init__(self, id, lexicon_config, supports=None, name_scopes=None,
+                 populate_spill_threshold=None, populate_max_workers=4,
+                 max_workers=1,
+                 client_cache_size=32, client_cache_expiry=900,
+                 rate_limit=None, rate_limit_burst=None,
+                 adaptive_concurrency=None, adaptive_latency_tolerance=2,
+                 retries=0,
+                 retry_backoff=1, retry_max_backoff=30, retry_budget=300,
+                 metrics_textfile=None, metrics_callback=None,
+                 trace_file=None, trace_hook=None, bulk_operations=True,
+                 max_api_calls=None,
+                 snapshot_cache=None, snapshot_ttl=300, journal_dir=None,
+                 zone_state_ttl=None, http_pool_size=10,
+                 http_timeout=60, http_compression=True, http_cache=False,
+                 async_max_workers=4, simulate=None, **kwargs):
 
         self.log = logging.getLogger('LexiconProvider[{}]'.format(id))
 
@@ -95,99 +426,363 @@ class LexiconProvider(BaseProvider):
 
         self.remembered_ids = RememberedIds()
         self.lexicon_config = lexicon_config
+        self.populate_spill_threshold = populate_spill_threshold
+        self.name_scopes = sorted({
+            '' if n.strip('.') == '@' else n.strip('.')
+            for n in name_scopes}) if name_scopes else None
+        self.listed_rtypes = sorted(self.SUPPORTS) \
+            if self.SUPPORTS != self.IMPLEMENTED else None
+        self.populate_max_workers = max(1, int(populate_max_workers))
+        self.max_workers = max(1, int(max_workers))
+        self.client_cache = LexiconClientCache(client_cache_size,
+                                               client_cache_expiry)
+        self._config_key = json.dumps(lexicon_config, sort_keys=True,
+                                      default=str)
+        self.rate_limiter = TokenBucket.for_account(
+            self._config_key, rate_limit, rate_limit_burst) \
+            if rate_limit else None
+        self.concurrency = AdaptiveConcurrency.for_account(
+            self._config_key, adaptive_concurrency, self.max_workers,
+            adaptive_latency_tolerance) if adaptive_concurrency else None
+        if self.concurrency is not None:
+            # the controller, rather than the pools, bounds the calls made
+            self.populate_max_workers = max(self.populate_max_workers,
+                                            self.concurrency.max_limit)
+            self.max_workers = max(self.max_workers,
+                                   self.concurrency.max_limit)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.retry_max_backoff = retry_max_backoff
+        self.retry_budget = retry_budget
+        self.metrics = ProviderMetrics(id, metrics_textfile,
+                                       metrics_callback)
+        self.tracer = SpanTracer(id, trace_file, trace_hook) \
+            if trace_file or trace_hook else None
+        self.bulk_operations = bulk_operations
+        self.max_api_calls = max_api_calls
+        self.snapshots = ZoneSnapshotCache(snapshot_cache, snapshot_ttl) \
+            if snapshot_cache else None
+        self.journal_dir = journal_dir
+        self.zone_states = ZoneStateCache(zone_state_ttl) \
+            if zone_state_ttl else None
+        # snapshots are keyed by a digest of the config, which holds secrets
+        # and by the slices listed, since they make up the snapshot
+        self._account = hashlib.sha256(json.dumps(
+            [self._config_key, self.listed_rtypes, self.name_scopes])
+            .encode('utf-8')).hexdigest()
+        self.http_session = PooledHttpSession(
+            http_pool_size, http_timeout, http_compression, http_cache) \
+            if http_pool_size else None
+        self.simulate = simulate
+        self._prefetched = {}
+        self._async_executor = ThreadPoolExecutor(
+            max_workers=max(1, int(async_max_workers)),
+            thread_name_prefix='octodns-lexicon-{}'.format(id))
+        self._cancellation = local()
 
     def populate(self, zone, target=False, lenient=False):
-
-        loaded_types = defaultdict(lambda: defaultdict(list))
+        try:
+            with self._span('populate', zone=zone.name) as span:
+                before = len(zone.records)
+                exists = self._populate(zone, lenient)
+                span.set(records=len(zone.records) - before, exists=exists)
+                return exists
+        finally:
+            self._flush()
+
+    def _span(self, name, **attributes):
+        # spans cost a single test while tracing is off
+        if self.tracer is None:
+            return _NO_SPAN
+        return self.tracer.span(name, attributes)
+
+    def _flush(self):
+        self.metrics.flush()
+        if self.tracer is not None:
+            self.tracer.flush()
+
+    def _populate(self, zone, lenient):
+        groups = LexiconRecordGroups(self.populate_spill_threshold)
         before = len(zone.records)
-        lexicon_client, _ = self._create_client(zone_name=zone.name[:-1])
         exists = False
 
-        lexicon_client.provider.authenticate()
-        for lexicon_record in lexicon_client.provider.list_records(
-                None, None, None):
-            # No way of knowing for sure whether a zone exists or not,
-            # But if it has contents, it is safe to assume that it does.
-            exists = True
-            self.log.debug("provider listed {!s}".format(lexicon_record))
+        # Ids are listed anew, aside, and replace the ones remembered by an
+        # earlier populate of the same zone once they are all in. Should
+        # populates of one zone overlap, the one started last wins.
+        generation = self.remembered_ids.begin_zone(zone.name)
+        remembered_ids = RememberedIds()
+
+        with self._span('populate.list_records', zone=zone.name) as span:
+            listing = self._prefetched.pop(zone.name, None)
+            if listing is None:
+                listing = self._list_zone(zone.name)
+            else:
+                self.log.debug('populate: using prefetched listing of %s',
+                               zone.name)
+            span.set(records=len(listing))
+
+        # Harmonizing and grouping go record by record, in a single pass
+        # over the listing, which is why they share a span.
+        with self._span('populate.group', zone=zone.name):
+            for lexicon_record in _consume(listing):
+                # No way of knowing for sure whether a zone exists or not,
+                # But if it has contents, it is safe to assume that it does.
+                exists = True
+                self.log.debug("provider listed {!s}".format(lexicon_record))
+
+                self._harmonize(lexicon_record, zone.name)
+                groups.add(_octodns_name(lexicon_record), lexicon_record)
+
+        for (record_by_name, record_type), lexicon_records in groups:
+            self.log.debug("Got {!s} from above".format(lexicon_records))
+
+            if record_type in self.SUPPORTS:
+
+                _data_func = getattr(self,
+                                     '_data_for_{}'.format(record_type))
+
+                with self._span('populate.data_for', rtype=record_type,
+                                values=len(lexicon_records)):
+                    data = _data_func(record_type, lexicon_records)
 
-            # harmonize record values here
-            if lexicon_record['type'] in ['CNAME', 'MX', 'NS']:
-                if not lexicon_record['content'][-1] == '.':
-                    domain_part = shlex.split(lexicon_record['content'])[-1]
-                    if '.' in domain_part:
-                        lexicon_record['content'] += '.'
-                    else:
-                        lexicon_record['content'] += ".{}".format(zone.name)
+                self.log.debug('populate: adding record {} records: {!s}'
+                               .format(record_by_name, data))
+
+                record_name = _zone_relative_name(record_by_name,
+                                                  zone.name)
+
+                with self._span('populate.record_new', rtype=record_type):
+                    record = Record.new(zone, record_name, data, source=self,
+                                        lenient=lenient)
+
+                # Some lexicon operations, specifically 'update',
+                # requires the 'identifier' to be used.
+                # Since that information is in the 'id' key, we save it
+                # in a dict from which it can be retrieved when applying
+                #
+                # Furthermore, where octodns saves multi value records as
+                # single record, lexicon has one record for each value.
+                # Therefore, the extra 'content' level is needed here, so
+                # that correct ID for correct record might be retrieved.
+                for lexicon_record in lexicon_records:
+                    remembered_ids.remember(record,
+                                            lexicon_record['content'],
+                                            lexicon_record['id'])
+
+                with self._span('populate.add_record', rtype=record_type):
+                    zone.add_record(record, lenient=lenient)
 
-                    self.log.info("Harmonizing [%s] -> [%s]",
-                                  domain_part, lexicon_record['content'])
+            else:
+                err_str = 'encountered unhandled record type: ' \
+                          '"{}" Payload was "{!s}"'.format(record_type,
+                                                           lexicon_records)
+                self.log.warning(err_str)
 
-            name = _octodns_name(lexicon_record)
-            loaded_types[name][lexicon_record["type"]].append(lexicon_record)
+        self.remembered_ids.adopt_zone(zone.name, remembered_ids, generation)
 
-        for record_by_name, data_by_id in loaded_types.items():
-            for record_type, lexicon_records in data_by_id.items():
-                self.log.debug("Got {!s} from above".format(lexicon_records))
+        self.log.info('populate:   found %s records, exists=%s',
+                      len(zone.records) - before, before < len(zone.records))
 
-                if record_type in self.SUPPORTS:
+        return exists
 
-                    _data_func = getattr(self,
-                                         '_data_for_{}'.format(record_type))
+    def _harmonize(self, lexicon_record, zone_name):
+        if lexicon_record['type'] in ['CNAME', 'MX', 'NS']:
+            if not lexicon_record['content'][-1] == '.':
+                domain_part = _last_token(lexicon_record['content'])
+                if '.' in domain_part:
+                    lexicon_record['content'] += '.'
+                else:
+                    lexicon_record['content'] += ".{}".format(zone_name)
 
-                    data = _data_func(record_type, lexicon_records)
+                self.log.info("Harmonizing [%s] -> [%s]",
+                              domain_part, lexicon_record['content'])
+        return lexicon_record
 
-                    self.log.debug('populate: adding record {} records: {!s}'
-                                   .format(record_by_name, data))
-
-                    if record_by_name.endswith(zone.name):
-                        # This should be handled in the various
-                        # Lexicon providers.
-                        #  However, there is no harm in doing some extra
-                        #  check for it here  - just in case.
-                        record_by_name = record_by_name.rstrip('.')
-
-                    if record_by_name.endswith(zone.name[:-1]):
-                        record_name = record_by_name[:-(len(zone.name))]
-                    else:
-                        record_name = record_by_name
-
-                    record = Record.new(zone, record_name, data, source=self, lenient=lenient)
-
-                    # Some lexicon operations, specifically 'update',
-                    # requires the 'identifier' to be used.
-                    # Since that information is in the 'id' key, we save it
-                    # in a dict from which it can be retrieved when applying
-                    #
-                    # Furthermore, where octodns saves multi value records as
-                    # single record, lexicon has one record for each value.
-                    # Therefore, the extra 'content' level is needed here, so
-                    # that correct ID for correct record might be retrieved.
-                    for lexicon_record in lexicon_records:
-                        self.remembered_ids.remember(record,
-                                                     lexicon_record['content'],
-                                                     lexicon_record['id'])
+    async def async_populate(self, zone, target=False, lenient=False,
+                             timeout=None):
+        """populate, without blocking the event loop.
 
-                    zone.add_record(record, lenient=lenient)
+        The lexicon calls run in a bounded pool of threads, so that many
+        zones can be populated concurrently, eg with asyncio.gather. zone
+        is only filled in once the listing completed: if this is cancelled,
+        or timeout seconds pass first, zone is left untouched.
+        """
+        scratch = Zone(zone.name, zone.sub_zones)
+        exists = await self._run_async(None, timeout, self.populate,
+                                       scratch, target, lenient)
+        for record in scratch.records:
+            zone.add_record(record.copy(zone=zone), lenient=lenient)
+        return exists
 
-                else:
-                    err_str = 'encountered unhandled record type: ' \
-                              '"{}" Payload was "{!s}"'.format(record_type,
-                                                               lexicon_records)
-                    self.log.warning(err_str)
+    async def async_apply(self, plan, timeout=None):
+        """apply, without blocking the event loop.
 
-        self.log.info('populate:   found %s records, exists=%s',
-                      len(zone.records) - before, before < len(zone.records))
+        If this is cancelled, or timeout seconds pass first, no further
+        change is made once the ones in flight complete.
 
-        return exists
+            :type return: the number of changes applied
+        """
+        return await self._run_async(Event(), timeout, self._apply_until,
+                                     plan)
+
+    def _apply_until(self, plan, cancelled):
+        self._cancellation.event = cancelled
+        try:
+            return self.apply(plan)
+        finally:
+            self._cancellation.event = None
+
+    async def _run_async(self, cancelled, timeout, func, *args):
+        import asyncio
+
+        if cancelled is not None:
+            args += (cancelled,)
+        future = asyncio.get_running_loop().run_in_executor(
+            self._async_executor, func, *args)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except BaseException:
+            # The thread cannot be interrupted, but it can be told to stop
+            # at its next opportunity.
+            if cancelled is not None:
+                cancelled.set()
+            raise
+
+    def prefetch(self, zone_names, max_workers=8):
+        """List the records of many zones concurrently, ahead of populate.
+
+        The listings are kept in memory, and the next populate of each zone
+        is served from there instead of from the provider. Zones which fail
+        to list are logged and skipped, populate will then list them again.
+
+            :param zone_names: names of the zones to prefetch
+            :param max_workers: max number of zones to list concurrently
+
+            :type return: list of the names of the zones prefetched
+        """
+        zone_names = {'{}.'.format(z.rstrip('.')) for z in zone_names}
+        self.log.info('prefetch: %d zones, max_workers=%d', len(zone_names),
+                      max_workers)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self._list_zone, zone_name): zone_name
+                       for zone_name in zone_names}
+
+        prefetched = []
+        for future, zone_name in futures.items():
+            try:
+                self._prefetched[zone_name] = future.result()
+            except Exception as e:
+                self.log.warning('prefetch: unable to list %s: %s',
+                                 zone_name, e)
+            else:
+                prefetched.append(zone_name)
+        return sorted(prefetched)
+
+    def _list_zone(self, zone_name):
+        if self.zone_states is not None:
+            listing = self.zone_states.get(self._account, zone_name)
+            if listing is not None:
+                self.log.debug('_list_zone: using the state of %s kept in '
+                               'memory', zone_name)
+                return listing
+
+        listing = self._list_zone_records(zone_name)
+        if self.zone_states is not None:
+            self.zone_states.put(self._account, zone_name, listing)
+        return listing
+
+    def _list_zone_records(self, zone_name):
+        if self.snapshots is not None:
+            listing = self.snapshots.get(self._account, zone_name)
+            if listing is not None:
+                self.log.debug('_list_zone: using snapshot of %s', zone_name)
+                journal = self._journal(zone_name)
+                if journal is not None and journal.exists():
+                    listing = self._reconcile(zone_name, listing, journal)
+                return listing
+
+        client = self._client_for(zone_name[:-1])
+        slices = [(rtype, name)
+                  for name in self.name_scopes or (None,)
+                  for rtype in self.listed_rtypes or (None,)]
+        if len(slices) == 1:
+            listing = self._list_slice(client, zone_name, *slices[0])
+        else:
+            self.log.debug('_list_zone: listing %s in %d slices', zone_name,
+                           len(slices))
+            with ThreadPoolExecutor(max_workers=min(
+                    self.populate_max_workers, len(slices))) as executor:
+                listing = [lexicon_record for part in executor.map(
+                    lambda s: self._list_slice(client, zone_name, *s),
+                    slices) for lexicon_record in part]
+        if self.snapshots is not None:
+            self.snapshots.put(self._account, zone_name, listing)
+        return listing
+
+    def _reconcile(self, zone_name, listing, journal):
+        """Bring the snapshot listing of zone_name up to date with the
+        operations an interrupted _apply started, listing only the rrsets
+        they touched."""
+        touched = {(rtype, _zone_relative_name(
+            _octodns_name({'name': name}), zone_name))
+            for rtype, name in journal.touched()}
+        self.log.info('_list_zone: %s was left half applied, listing the '
+                      '%d rrsets touched', zone_name, len(touched))
+        client = self._client_for(zone_name[:-1])
+        listing = [r for r in listing
+                   if (r['type'], _zone_relative_name(_octodns_name(r),
+                                                      zone_name))
+                   not in touched]
+        for rtype, name in sorted(touched):
+            listing.extend(self._list_slice(client, zone_name, rtype, name))
+        self.snapshots.put(self._account, zone_name, listing, keep_age=True)
+        journal.remove()
+        return listing
+
+    def _list_slice(self, client, zone_name, rtype, name):
+        if name is None:
+            lexicon_name = None
+        elif name == '':
+            lexicon_name = '@.{}'.format(zone_name)
+        else:
+            lexicon_name = '{}.{}'.format(name, zone_name)
+
+        listing = self._provider_call(client, 'list_records', rtype,
+                                      lexicon_name, None)
+        # Providers are not all as picky about the filters, and records of
+        # other slices would be listed twice.
+        return [r for r in listing
+                if (rtype is None or r['type'] == rtype) and
+                (name is None or _zone_relative_name(
+                    _octodns_name(r), zone_name) == name)]
+
+    def _process_desired_zone(self, desired):
+        if self.name_scopes is not None:
+            for record in desired.records:
+                if record.name not in self.name_scopes:
+                    self.log.debug('_process_desired_zone: %s is out of '
+                                   'scope', record.fqdn)
+                    desired.remove_record(record)
+        return super(LexiconProvider, self)._process_desired_zone(desired)
 
     def _create_client(self, zone_name):
+        # lexicon, and the lexicon provider module, are only imported once
+        # a zone is actually handled, as octodns loads every provider class
+        # configured, whether the run needs it or not.
+        from lexicon.client import Client as LexiconClient
+        from lexicon.config import ConfigResolver as LexiconConfigResolver
+
         config = LexiconConfigResolver()
         dynamic_config = OnTheFlyLexiconConfigSource(zone_name)
 
         config.with_config_source(dynamic_config) \
             .with_env().with_dict(self.lexicon_config)
 
+        if self.simulate is not None:
+            return SimulatedClient(
+                SimulatedProvider(config, **self.simulate)), dynamic_config
+
         try:
             return LexiconClient(config), dynamic_config
         except AttributeError as e:
@@ -202,100 +797,560 @@ class LexiconProvider(BaseProvider):
 
             :type return: void
         """
+        try:
+            with self._span('apply', zone=plan.desired.name,
+                            changes=len(plan.changes)):
+                self._apply_plan(plan)
+        finally:
+            self._flush()
+
+    def _apply_plan(self, plan):
         desired = plan.desired
         changes = plan.changes
         zone_name = plan.existing.name[:-1]
-        lexicon_client, dynamic_config = self._create_client(zone_name)
-
-        self.log.debug('_apply: zone=%s, len(changes)=%d', desired.name,
-                       len(changes))
-        lexicon_client.provider.authenticate()
-
-        for change in changes:
-            _rrset_func = getattr(
-                self, '_rrset_for_{}'.format(change.record._type))
-
-            # Only way to update TTL is to hope that the provider shall read
-            # this one for all operations
-            dynamic_config.set_ttl(change.record.ttl)
-
-            old_vars = _rrset_func(change.existing) \
-                if change.existing else set()
-            new_vars = _rrset_func(change.new) \
-                if change.new else set()
+        client = self._client_for(zone_name)
+
+        self.log.debug('_apply: zone=%s, len(changes)=%d, max_workers=%d',
+                       desired.name, len(changes), self.max_workers)
+
+        with self._span('apply.rrsets', zone=desired.name) as span:
+            operations = [self._operations_for_change(change,
+                                                      client.adapter)
+                          for change in changes]
+            span.set(operations=sum(map(len, operations)))
+        journal = self._journal(plan.existing.name)
+        if journal is not None:
+            with self._span('apply.resume', zone=desired.name):
+                remaining = self._resume(client, journal, operations)
+        else:
+            remaining = operations
+
+        # a resumed _apply is only charged for what is left to do
+        estimate = self._estimate(plan.existing.name, remaining)
+        self.log.info('_apply: %d provider calls to make: %s',
+                      estimate['total'], estimate['by_action'])
+        if self.max_api_calls is not None and \
+                estimate['total'] > self.max_api_calls:
+            if journal is not None and remaining is operations:
+                # nothing to resume, the journal holds just this plan
+                journal.remove()
+            raise ApiCallBudgetExceeded(estimate, self.max_api_calls)
+        operations = remaining
+
+        cancelled = getattr(self._cancellation, 'event', None)
+        try:
+            with self._span('apply.operations', zone=desired.name,
+                            operations=sum(map(len, operations))):
+                self._apply_all_operations(client, operations, cancelled,
+                                           journal)
+        except Exception as e:
+            with self._span('apply.error', zone=desired.name,
+                            error=type(e).__name__):
+                if self.zone_states is not None:
+                    self.zone_states.invalidate(self._account,
+                                                plan.existing.name)
+                if self.snapshots is not None and journal is None:
+                    # which of the changes made it is anyone's guess
+                    self.snapshots.invalidate(self._account,
+                                              plan.existing.name)
+            raise
+
+        if self.zone_states is not None or self.snapshots is not None:
+            with self._span('apply.write_through', zone=desired.name):
+                self._write_through(client, plan.existing.name, changes,
+                                    operations)
+        if journal is not None:
+            journal.remove()
+
+    def _journal(self, zone_name):
+        if not self.journal_dir:
+            return None
+        return ApplyJournal(os.path.join(self.journal_dir, '{}{}.journal'
+                                         .format(zone_name,
+                                                 self._account[:12])))
+
+    def _resume(self, client, journal, operations):
+        """Leave out of operations those which the journal of an earlier
+        attempt at the very same operations confirms, and those it started
+        which turn out to have been applied."""
+        started, done = journal.begin(operations)
+        if not started:
+            return operations
+
+        def pending(operation):
+            key = ApplyJournal.key(operation)
+            if key in done:
+                return False
+            if key in started and self._is_applied(
+                    client, operation.action, operation.record):
+                self.log.info('_resume: %s %s had been applied',
+                              operation.action, operation.record)
+                return False
+            return True
+
+        remaining = [[o for o in change_operations if pending(o)]
+                     for change_operations in operations]
+        self.log.info('_resume: %d of %d operations left to apply',
+                      sum(map(len, remaining)), sum(map(len, operations)))
+        return remaining
+
+    def _apply_all_operations(self, client, operations, cancelled=None,
+                              journal=None):
+        # Changes to rrsets of the same name are not independent: octodns
+        # orders the Delete of an A before the Create of a CNAME in its
+        # place, and providers reject a CNAME next to other data. So the
+        # changes of one name go to a single worker, in the order of the
+        # plan, and only changes to different names run concurrently.
+        by_name = OrderedDict()
+        for change_operations in operations:
+            if change_operations:
+                by_name.setdefault(change_operations[0].record.name,
+                                   []).append(change_operations)
+
+        if self.max_workers <= 1 or len(by_name) <= 1:
+            for changes in by_name.values():
+                self._apply_changes(client, changes, cancelled, journal)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._apply_changes, client, changes,
+                                       cancelled, journal)
+                       for changes in by_name.values()]
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in not_done:
+                future.cancel()
+
+        for future in futures:
+            if not future.cancelled():
+                future.result()
+
+    def _apply_changes(self, client, changes, cancelled=None, journal=None):
+        for change_operations in changes:
+            self._apply_operations(client, change_operations, cancelled,
+                                   journal)
+
+    def _write_through(self, client, zone_name, changes, operations):
+        """Carry the applied changes over to the state kept of zone_name,
+        in memory and in the snapshot.
+
+        The rrsets changed are replaced by their new values. Values which
+        were updated keep the id they had. With zone_state_ttl, the rrsets
+        in which values were created are listed for their new ids, which
+        are remembered along with the others. Otherwise, created values
+        have no id until the zone is listed again, and are then created and
+        deleted by content rather than updated.
+        """
+        changed = {}
+        relisted = []
+        for change, change_operations in zip(changes, operations):
+            record = change.new or change.existing
+            if self._relists(change_operations):
+                relisted.append(record)
+                continue
+            updated = {o.record.content: o.identifier
+                       for o in change_operations
+                       if o.action == 'update_record'}
+            new_vars = getattr(self, '_rrset_for_{}'.format(
+                record._type))(change.new) if change.new else set()
+            changed[(record.name, record._type)] = [{
+                'type': r.rtype,
+                'name': r.name,
+                'ttl': r.ttl,
+                'content': _unescaped(r.content),
+                'id': updated.get(r.content) or (
+                    self.remembered_ids.get(change.existing, r.content)
+                    if change.existing else None)
+            } for r in sorted(new_vars)]
 
-            additions = new_vars - old_vars
-            deletions = old_vars - new_vars
+        try:
+            for record in relisted:
+                changed[(record.name, record._type)] = self._list_slice(
+                    client, zone_name, record._type, record.name)
+        except Exception as e:
+            self.log.warning('_write_through: unable to list the rrsets '
+                             'created in %s, dropping its state: %s',
+                             zone_name, e)
+            self.zone_states.invalidate(self._account, zone_name)
+            if self.snapshots is not None:
+                self.snapshots.invalidate(self._account, zone_name)
+            return
+
+        if self.zone_states is not None:
+            for change in changes:
+                record = change.new or change.existing
+                self.remembered_ids.replace(record, [
+                    (self._harmonize(dict(r), zone_name)['content'], r['id'])
+                    for r in changed[(record.name, record._type)]
+                    if r['id'] is not None])
+
+        for store in (self.zone_states, self.snapshots):
+            listing = store.get(self._account, zone_name) \
+                if store is not None else None
+            if listing is None:
+                continue
+            listing = [r for r in listing
+                       if (_zone_relative_name(_octodns_name(r), zone_name),
+                           r['type']) not in changed]
+            for new_records in changed.values():
+                listing.extend(new_records)
+            store.put(self._account, zone_name, listing, keep_age=True)
+
+    def _relists(self, change_operations):
+        # Whether _write_through lists the rrset of change_operations, for
+        # the ids of the values they create.
+        return self.zone_states is not None and any(
+            o.action == 'create_record' or
+            (o.action == 'replace_rrset' and o.record.content)
+            for o in change_operations)
+
+    def estimate_api_calls(self, plan):
+        """Count the provider calls _apply would make to carry out plan.
+
+        The calls are worked out just like _apply does, and counted per
+        action (create_record, update_record, delete_record or
+        replace_rrset) and per record type. With zone_state_ttl, the
+        list_records calls made afterwards for the ids of created values
+        are counted too. Retries are not accounted for, and neither is
+        authenticate.
 
-            additions_iter = iter(sorted(additions))
-            deletions_iter = iter(sorted(deletions))
+            :param plan: Contains the zones and changes to be made
+            :type  plan: octodns.provider.base.Plan
 
-            for i in range(0, min(len(additions), len(deletions))):
-                new_record = next(additions_iter)
-                old_record = next(deletions_iter)
-                identifier = self.remembered_ids.get(change.existing,
-                                                     old_record.content)
+            :type return: dict of zone, total, by_action and by_rtype
+        """
+        client = self._client_for(plan.existing.name[:-1])
+        return self._estimate(plan.existing.name, [
+            self._operations_for_change(change, client.adapter)
+            for change in plan.changes])
+
+    def _estimate(self, zone_name, operations):
+        by_action = defaultdict(int)
+        by_rtype = defaultdict(int)
+        for change_operations in operations:
+            for operation in change_operations:
+                by_action[operation.action] += 1
+                by_rtype[operation.record.rtype] += 1
+            if self._relists(change_operations):
+                by_action['list_records'] += 1
+                by_rtype[change_operations[0].record.rtype] += 1
+        return {
+            'zone': zone_name,
+            'total': sum(by_action.values()),
+            'by_action': dict(by_action),
+            'by_rtype': dict(by_rtype)
+        }
 
-                if identifier and self.remembered_ids.has_unique_ids(
-                        change.existing):
+    def _apply_operations(self, client, operations, cancelled=None,
+                          journal=None):
+        for operation in operations:
+            if cancelled is not None and cancelled.is_set():
+                raise CancelledError('_apply cancelled before {}'.format(
+                    operation.record))
+            if journal is not None:
+                journal.append('started', operation)
+            self._execute(client, operation)
+            if journal is not None:
+                journal.append('done', operation)
+
+    def _execute(self, client, operation):
+        action, record, identifier = operation
+        if action == 'create_record':
+            self.log.info('client create_record {!s}'.format(record))
+            self._mutate(client, action, record, RecordCreateError)
+        elif action == 'update_record':
+            self.log.info('client update [id:{}] {!s}'.format(identifier,
+                                                             record))
+            self._mutate(client, action, record, RecordUpdateError,
+                         identifier=identifier)
+        elif action == 'replace_rrset':
+            self.log.info('client replace_rrset {!s}'.format(record))
+            self._mutate(client, action, record, RecordUpdateError)
+        else:
+            self.log.info('client delete_record {!s}'.format(record))
+            self._mutate(client, action, record, RecordDeleteError,
+                         identifier=identifier)
+
+    def _operations_for_change(self, change, bulk_adapter=None):
+        """Work out the provider operations which carry out change.
+
+        Values found on both sides are left alone. The others are paired
+        up, values of equal content first, so that a TTL only change stays
+        an update of that very value, and the rest in sorted order. A pair
+        is an update when the ids of the record are unique, else a create
+        and a delete.
+
+        This is weighed against replacing the rrset as a whole, in one
+        call when there is a bulk_adapter, and the cheaper of both, in
+        number of provider calls, is returned.
+        """
+        _rrset_func = getattr(
+            self, '_rrset_for_{}'.format(change.record._type))
+
+        old_vars = _rrset_func(change.existing) \
+            if change.existing else set()
+        new_vars = _rrset_func(change.new) \
+            if change.new else set()
+
+        additions = new_vars - old_vars
+        deletions = old_vars - new_vars
+        if not additions and not deletions:
+            return []
+
+        unique_ids = change.existing is None or \
+            self.remembered_ids.has_unique_ids(change.existing)
+
+        def identifier(old_record):
+            # A shared id would not tell the values of the record apart,
+            # and some providers would delete them all by it.
+            if not unique_ids:
+                return None
+            return self.remembered_ids.get(change.existing,
+                                           old_record.content)
+
+        candidates = [
+            self._per_value_operations(additions, deletions, identifier),
+            self._replace_operations(old_vars, new_vars, identifier,
+                                     bulk_adapter)]
+        return min(candidates, key=self._cost)
+
+    def _per_value_operations(self, additions, deletions, identifier):
+        added_by_content = {r.content: r for r in additions}
+        pairs = []
+        for old_record in sorted(deletions):
+            new_record = added_by_content.pop(old_record.content, None)
+            if new_record is not None:
+                pairs.append((new_record, old_record))
+        paired = {old_record for _, old_record in pairs}
+        deletions = sorted(deletions - paired)
+        additions = sorted(added_by_content.values())
+        n = min(len(additions), len(deletions))
+        pairs.extend(zip(additions[:n], deletions[:n]))
+        additions, deletions = additions[n:], deletions[n:]
+
+        operations = []
+        for new_record, old_record in pairs:
+            old_id = identifier(old_record)
+            if old_id:
+                operations.append(
+                    LexiconOperation('update_record', new_record, old_id))
+            elif new_record.content == old_record.content:
+                # Creating a value which is there already would be a no-op
+                # for most providers, and deleting it afterwards would lose
+                # it, so this pair has to go the other way around.
+                operations.append(
+                    LexiconOperation('delete_record', old_record, None))
+                operations.append(
+                    LexiconOperation('create_record', new_record, None))
+            else:
+                operations.append(
+                    LexiconOperation('create_record', new_record, None))
+                operations.append(
+                    LexiconOperation('delete_record', old_record, None))
+
+        operations.extend(LexiconOperation('create_record', r, None)
+                          for r in additions)
+        operations.extend(LexiconOperation('delete_record', r, identifier(r))
+                          for r in deletions)
+        return operations
+
+    def _replace_operations(self, old_vars, new_vars, identifier,
+                            bulk_adapter):
+        if bulk_adapter is not None:
+            # The content of the record is all of the values of the rrset.
+            any_record = next(iter(new_vars or old_vars))
+            return [LexiconOperation('replace_rrset', LexiconRecord(
+                content=tuple(sorted(r.content for r in new_vars)),
+                ttl=any_record.ttl, rtype=any_record.rtype,
+                name=any_record.name), None)]
+        return [LexiconOperation('delete_record', r, identifier(r))
+                for r in sorted(old_vars)] + \
+            [LexiconOperation('create_record', r, None)
+             for r in sorted(new_vars)]
+
+    @staticmethod
+    def _cost(operations):
+        return len(operations)
+
+    def _mutate(self, client, action, record, error, **kwargs):
+        """Create, update or delete record, retrying transient failures.
+
+        A falsy return from the provider raises error once retries are
+        exhausted, whereas exceptions are re-raised as they are.
+        """
+        deadline = time.monotonic() + self.retry_budget
+        attempt = 0
+        while True:
+            try:
+                if self._provider_call(client, action, record=record,
+                                       **kwargs):
+                    return
+                failure = None
+            except Exception as e:
+                if not _is_transient_error(e):
+                    raise
+                failure = e
+
+            attempt += 1
+            delay = random.uniform(0, min(
+                self.retry_max_backoff,
+                self.retry_backoff * 2 ** (attempt - 1)))
+            if attempt > self.retries or \
+                    time.monotonic() + delay > deadline:
+                if failure is not None:
+                    raise failure
+                raise error(record, kwargs.get('identifier'))
+
+            self.log.warning('%s %s failed (%s), retry %d/%d in %.2fs',
+                             action, record, failure or 'falsy return',
+                             attempt, self.retries, delay)
+            self.metrics.retry(action, client.zone, record.rtype)
+            with self._span('apply.retry', action=action, zone=client.zone,
+                            rtype=record.rtype, attempt=attempt,
+                            delay=delay) as span:
+                time.sleep(delay)
+
+                # The failed attempt may still have reached the provider, so
+                # look before trying again, lest records get created twice.
+                applied = self._is_applied(client, action, record)
+                span.set(applied=applied)
+            if applied:
+                self.log.info('%s %s had been applied after all', action,
+                              record)
+                return
+
+    def _is_applied(self, client, action, record):
+        """Whether the provider lists record as action left it, TTL
+        included.
+
+        A create which cannot be verified is not retried, lest it be made
+        twice: the error of the listing is raised instead.
+        """
+        content = record.content
+        content = [_unescaped(c) for c in content] \
+            if action == 'replace_rrset' else _unescaped(content)
+        try:
+            listed = self._provider_call(
+                client, 'list_records', record.rtype, record.name,
+                None if action == 'replace_rrset' else content)
+        except Exception as e:
+            self.log.warning('unable to verify %s: %s', record, e)
+            if action == 'create_record':
+                raise
+            return False
+
+        listed = [r for r in listed if r['type'] == record.rtype]
+        if action == 'replace_rrset':
+            return {r['content'].rstrip('.') for r in listed} == \
+                {c.rstrip('.') for c in content} and \
+                all(_same_ttl(r, record.ttl) for r in listed)
+
+        matching = [r for r in listed
+                    if r['content'].rstrip('.') == content.rstrip('.')]
+        if action == 'delete_record':
+            return not matching
+        return any(_same_ttl(r, record.ttl) for r in matching)
+
+    def _client_for(self, zone_name):
+        """Get an authenticated client for zone_name, reusing a cached one
+        for as long as it is fresh."""
+        key = (zone_name, self._config_key)
+        client = self.client_cache.get(key)
+        if client is None:
+            lexicon_client, dynamic_config = self._create_client(zone_name)
+            client = CachedLexiconClient(lexicon_client, dynamic_config,
+                                         self._bulk_adapter_for(
+                                             lexicon_client.provider),
+                                         self.http_session)
+            self.log.debug('_client_for: authenticating zone=%s', zone_name)
+            self._call(client, 'authenticate', None)
+            self.client_cache.put(key, client)
+        return client
+
+    def _bulk_adapter_for(self, provider):
+        if not self.bulk_operations:
+            return None
+        adapter = BULK_ADAPTERS.get(self.lexicon_config.get('provider_name'))
+        if adapter is None or not adapter.supports(provider):
+            return None
+        return adapter
 
-                    self.log.info('client update [id:{}] {!s}'.format(
-                        identifier, new_record))
+    def _provider_call(self, client, action, *args, record=None, **kwargs):
+        """Call action on the wrapped lexicon provider of client.
 
-                    if not lexicon_client.provider.update_record(
-                            identifier=identifier, **new_record.func_args()):
-                        raise RecordUpdateError(new_record, identifier)
+        When a record is given, its func_args are passed along, and its TTL
+        is made visible to the provider for the duration of the call only.
+        The TTL travels with the record rather than living in the shared
+        config source, so concurrent operations each resolve their own.
+        """
+        if record is not None:
+            kwargs.update(record.func_args())
+            ttl = record.ttl
+        else:
+            ttl = None
 
-                else:
-                    self.log.info(
-                        'client create_record {!s}'.format(new_record))
-
-                    if not lexicon_client.provider.create_record(
-                            **new_record.func_args()):
-                        raise RecordCreateError(new_record)
-
-                    self.log.info('client delete_record {!s}'.format(
-                        old_record))
-                    if not lexicon_client.provider.delete_record(
-                            **old_record.func_args()):
-                        raise RecordDeleteError(old_record)
-
-            for new_record in additions_iter:
-                self.log.info('client create_record {!s}'.format(new_record))
-                if not lexicon_client.provider.create_record(
-                        **new_record.func_args()):
-                    raise RecordCreateError(new_record)
-
-            for old_record in deletions_iter:
-                self.log.info('client delete_record {!s}'.format(old_record))
-                identifier = self.remembered_ids.get(change.existing,
-                                                     old_record.content)
-
-                if not lexicon_client.provider.delete_record(
-                        identifier=identifier, **old_record.func_args()):
-                    raise RecordDeleteError(old_record)
+        try:
+            return self._call(client, action, ttl, *args, **kwargs)
+        except Exception as e:
+            if not _is_auth_error(e):
+                raise
+            # Cached credentials (or a session token obtained by the lexicon
+            # provider in authenticate) may have gone stale since the client
+            # was cached, so authenticate again and give it one more try.
+            self.log.info('_provider_call: %s rejected, re-authenticating',
+                          action)
+            self._call(client, 'authenticate', None)
+            return self._call(client, action, ttl, *args, **kwargs)
+
+    def _call(self, client, action, ttl, *args, **kwargs):
+        # Every single request towards the wrapped provider passes here.
+        if self.concurrency is None:
+            return self._call_now(client, action, ttl, *args, **kwargs)
+        ticket = self.concurrency.acquire()
+        start = time.perf_counter()
+        error = None
+        try:
+            return self._call_now(client, action, ttl, *args, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.concurrency.release(ticket, action,
+                                     time.perf_counter() - start, error)
+
+    def _call_now(self, client, action, ttl, *args, **kwargs):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        rtype = kwargs.get('rtype', args[0] if args else None)
+        with self._span('lexicon.' + action, zone=client.zone,
+                        rtype=rtype) as span:
+            start = time.perf_counter()
+            try:
+                result = client.call(action, ttl, *args, **kwargs)
+            except Exception as e:
+                self.metrics.observe(action, client.zone, rtype,
+                                     time.perf_counter() - start, e)
+                raise
+            error = None if result or action not in _MUTATIONS else False
+            self.metrics.observe(action, client.zone, rtype,
+                                 time.perf_counter() - start, error)
+            if error is False:
+                span.set(error='false')
+        return result
 
     def _data_for_multiple(self, _type, lexicon_records):
         return {
             'ttl': lexicon_records[0]['ttl'],
             'type': _type,
-            'values': [re.sub(';', '\\;', r['content'])
+            'values': [r['content'].replace(';', '\\;')
                        for r in lexicon_records]
         }
 
     def _data_for_CAA(self, _type, lexicon_records):
-        values = []
-        for record in lexicon_records:
-            flags, tag, value = shlex.split(record["content"])
-            values.append({
-                'flags': flags,
-                'tag': tag,
-                'value': value
-            })
         return {
             'ttl': lexicon_records[0]['ttl'],
             'type': _type,
-            'values': values
+            'values': CONTENT_CODECS['CAA'].parse_all(
+                r['content'] for r in lexicon_records)
         }
 
     def _data_for_CNAME(self, _type, lexicon_records):
@@ -307,32 +1362,19 @@ class LexiconProvider(BaseProvider):
         }
 
     def _data_for_MX(self, _type, lexicon_records):
-        values = []
-        for record in lexicon_records:
-            priority, exchange = shlex.split(record["content"])
-            values.append({"priority": priority, "exchange": exchange})
-
         return {
             'ttl': lexicon_records[0]['ttl'],
             'type': _type,
-            'values': values
+            'values': CONTENT_CODECS['MX'].parse_all(
+                r['content'] for r in lexicon_records)
         }
 
     def _data_for_SRV(self, _type, lexicon_records):
-        values = []
-        for record in lexicon_records:
-            priority, weight, port, target = shlex.split(record['content'])
-
-            values.append({
-                'priority': priority,
-                'weight': weight,
-                'port': port,
-                'target': target
-            })
         return {
             'type': _type,
             'ttl': lexicon_records[0]['ttl'],
-            'values': values
+            'values': CONTENT_CODECS['SRV'].parse_all(
+                r['content'] for r in lexicon_records)
         }
 
     _data_for_A = _data_for_multiple
@@ -345,42 +1387,30 @@ class LexiconProvider(BaseProvider):
 
     _data_for_TXT = _data_for_multiple
 
+    def _rrset(self, octodns_record, contents):
+        ttl = octodns_record.ttl
+        rtype = octodns_record._type
+        name = _lexicon_fqdn(octodns_record)
+        return {LexiconRecord(content=c, ttl=ttl, rtype=rtype, name=name)
+                for c in contents}
+
     def _rrset_for_multiple(self, octodns_record):
-        return {LexiconRecord(content=c,
-                              ttl=octodns_record.ttl,
-                              rtype=octodns_record._type,
-                              name=_lexicon_fqdn(octodns_record)) for
-                c in octodns_record.values}
+        return self._rrset(octodns_record, octodns_record.values)
 
     def _rrset_for_CAA(self, octodns_record):
-        return {LexiconRecord(
-            content='{} {} "{}"'.format(c.flags, c.tag, c.value),
-            ttl=octodns_record.ttl,
-            rtype=octodns_record._type,
-            name=_lexicon_fqdn(octodns_record))
-            for c in octodns_record.values}
+        return self._rrset(octodns_record, CONTENT_CODECS['CAA'].format_all(
+            octodns_record.values))
 
     def _rrset_for_CNAME(self, octodns_record):
-        return {LexiconRecord(content=octodns_record.value,
-                              ttl=octodns_record.ttl,
-                              rtype=octodns_record._type,
-                              name=_lexicon_fqdn(octodns_record))}
+        return self._rrset(octodns_record, (octodns_record.value,))
 
     def _rrset_for_MX(self, octodns_record):
-        return {LexiconRecord(content='{} {}'.format(c.preference, c.exchange),
-                              ttl=octodns_record.ttl,
-                              rtype=octodns_record._type,
-                              name=_lexicon_fqdn(octodns_record))
-                for c in octodns_record.values}
+        return self._rrset(octodns_record, CONTENT_CODECS['MX'].format_all(
+            octodns_record.values))
 
     def _rrset_for_SRV(self, octodns_record):
-        return {LexiconRecord(
-            content='{} {} {} {}'.format(
-                c.priority, c.weight, c.port, c.target),
-            ttl=octodns_record.ttl,
-            rtype=octodns_record._type,
-            name=_lexicon_fqdn(octodns_record))
-            for c in octodns_record.values}
+        return self._rrset(octodns_record, CONTENT_CODECS['SRV'].format_all(
+            octodns_record.values))
 
     _rrset_for_A = _rrset_for_multiple
 
@@ -394,16 +1424,69 @@ class LexiconProvider(BaseProvider):
 
 
 class RememberedIds:
+    """Lexicon ids of the values of octodns records, scoped per zone.
+
+    Records are keyed by their (name, type) within their zone, and every
+    entry keeps track of whether its ids are unique as they are remembered,
+    so that no lookup needs to format or scan the record.
+    """
 
     def __init__(self):
         self.lock = Lock()
-        self._id_by_record_and_value = defaultdict(dict)
-        self._all_ids_for_record = defaultdict(list)
+        self._by_zone = defaultdict(dict)
+        self._started = defaultdict(int)
+        self._adopted = {}
+
+    @staticmethod
+    def _key(record):
+        return record.zone.name, (record.name, record._type)
+
+    def _entry(self, record):
+        zone_name, key = self._key(record)
+        return self._by_zone.get(zone_name, {}).get(key)
 
     def remember(self, record, content, _id):
+        zone_name, key = self._key(record)
+        with self.lock:
+            records = self._by_zone[zone_name]
+            entry = records.get(key)
+            if entry is None:
+                entry = records[key] = _RememberedRecordIds()
+            entry.add(content, _id)
+
+    def begin_zone(self, zone_name):
+        """Number the listing of zone_name about to start, for adopt_zone.
+        """
         with self.lock:
-            self._id_by_record_and_value[repr(record)][content] = _id
-            self._all_ids_for_record[repr(record)].append(_id)
+            self._started[zone_name] += 1
+            return self._started[zone_name]
+
+    def adopt_zone(self, zone_name, other, generation):
+        """Replace what is remembered for zone_name by what other remembers
+        of it, unless a listing begun after generation was adopted already.
+
+            :type return: whether other was adopted
+        """
+        with self.lock:
+            if generation < self._adopted.get(zone_name, 0):
+                return False
+            self._by_zone[zone_name] = other._by_zone.get(zone_name, {})
+            self._adopted[zone_name] = generation
+            return True
+
+    def replace(self, record, ids):
+        """Remember the (content, id) pairs of ids for record, in place of
+        whatever was remembered for it."""
+        zone_name, key = self._key(record)
+        entry = _RememberedRecordIds()
+        for content, _id in ids:
+            entry.add(content, _id)
+        with self.lock:
+            records = self._by_zone[zone_name]
+            if entry.ids:
+                records[key] = entry
+            else:
+                records.pop(key, None)
 
     def has_unique_ids(self, record):
         # We *want* to use update op when ever possible, because it is
@@ -422,17 +1505,906 @@ class RememberedIds:
         # performed either if all the ids encountered are unique, or else
         # if there are only one value for that record present already, in
         # which case the id is unique simply by being the only one.
-        return len(self._all_ids_for_record[repr(record)]) == \
-            len(set(self._all_ids_for_record[repr(record)]))
+        entry = self._entry(record)
+        return entry is None or entry.unique
 
     def get(self, record, content):
-        try:
-            return self._id_by_record_and_value[repr(record)][content]
-        except KeyError:
+        if not isinstance(record, Record):
             return None
+        entry = self._entry(record)
+        return None if entry is None else entry.id_by_content.get(content)
 
     def get_all_ids(self, record):
-        return self._all_ids_for_record[repr(record)]
+        entry = self._entry(record)
+        return [] if entry is None else entry.ids
+
+
+class _RememberedRecordIds:
+    __slots__ = ('id_by_content', 'ids', 'seen', 'unique')
+
+    def __init__(self):
+        self.id_by_content = {}
+        self.ids = []
+        self.seen = set()
+        self.unique = True
+
+    def add(self, content, _id):
+        self.id_by_content[content] = _id
+        self.ids.append(_id)
+        if _id in self.seen:
+            self.unique = False
+        else:
+            self.seen.add(_id)
+
+
+class LexiconRecordGroups:
+    """Groups listed lexicon records by (name, type), incrementally.
+
+    Only the fields needed to build octodns records are kept, in tuples,
+    and once more than spill_threshold records are held, they are sorted
+    and spilled to a temporary file. Iterating merges the spilled runs, so
+    that at most one group at a time needs to be in memory.
+    """
+
+    FIELDS = ('ttl', 'content', 'id')
+
+    def __init__(self, spill_threshold=None):
+        self.spill_threshold = spill_threshold
+        self._groups = defaultdict(list)
+        self._held = 0
+        self._seq = 0
+        self._runs = []
+
+    def add(self, name, lexicon_record):
+        self._groups[(name, lexicon_record['type'])].append(
+            (self._seq,) + tuple(lexicon_record[f] for f in self.FIELDS))
+        self._seq += 1
+        self._held += 1
+        if self.spill_threshold and self._held >= self.spill_threshold:
+            self._spill()
+
+    def _spill(self):
+        run = tempfile.TemporaryFile(mode='w+')
+        for (name, rtype), values in sorted(self._groups.items()):
+            for value in values:
+                run.write(json.dumps([name, rtype, *value]))
+                run.write('\n')
+        run.seek(0)
+        self._runs.append(run)
+        self._groups.clear()
+        self._held = 0
+
+    def _merged_runs(self):
+        if self._held:
+            self._spill()
+        runs = [map(json.loads, run) for run in self._runs]
+        try:
+            for key, rows in groupby(heapq.merge(*runs,
+                                                 key=lambda r: r[:3]),
+                                     key=lambda r: (r[0], r[1])):
+                yield key, [row[2:] for row in rows]
+        finally:
+            for run in self._runs:
+                run.close()
+            self._runs = []
+
+    def __iter__(self):
+        if self._runs:
+            groups = self._merged_runs()
+        else:
+            groups = self._popped_groups()
+        for (name, rtype), values in groups:
+            yield (name, rtype), [
+                dict(zip(self.FIELDS, value[1:]), name=name, type=rtype)
+                for value in values]
+
+    def _popped_groups(self):
+        while self._groups:
+            yield self._groups.popitem()
+        self._held = 0
+
+
+class CachedLexiconClient:
+
+    def __init__(self, lexicon_client, dynamic_config, adapter=None,
+                 http_session=None):
+        self.lexicon_client = lexicon_client
+        self.dynamic_config = dynamic_config
+        self.provider = lexicon_client.provider
+        self.adapter = adapter
+        self.http_session = http_session
+        self.zone = dynamic_config.domain
+        self.last_used = time.monotonic()
+        if http_session is not None:
+            _route_requests(self.provider)
+
+    def call(self, action, ttl, *args, **kwargs):
+        try:
+            with _using_http_session(self.http_session), \
+                    self._caching(action):
+                if action == 'replace_rrset':
+                    return self.adapter.replace_rrset(self.provider, ttl=ttl,
+                                                      **kwargs)
+                func = getattr(self.provider, action)
+                if ttl is None:
+                    return func(*args, **kwargs)
+                with self.dynamic_config.using_ttl(ttl):
+                    return func(*args, **kwargs)
+        finally:
+            # The provider may not have made its changes through the session
+            if self.http_session is not None and \
+                    (action in _MUTATIONS or action == 'replace_rrset'):
+                self.http_session.invalidate()
+
+    def _caching(self, action):
+        if self.http_session is None:
+            return nullcontext()
+        return self.http_session.caching(action in _CACHED_ACTIONS)
+
+
+class PooledHttpSession:
+    """requests session holding the keep-alive connections of the zones of
+    one LexiconProvider, with a default timeout.
+
+    With cache, successful GET responses are kept for the life of the
+    session, ie one octodns run, and served again to identical GETs. Those
+    which came with an ETag or Last-Modified are revalidated with a
+    conditional request first. Any other request empties the cache. Only
+    the GETs made while caching() are cached, the others are always sent.
+    """
+
+    IDEMPOTENT = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
+    def __init__(self, pool_size=10, timeout=None, compression=True,
+                 cache=False):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.compression = compression
+        self.lock = Lock()
+        self.cache = {} if cache else None
+        self.hits = 0
+        self.revalidations = 0
+        self._session = None
+        self._caching = local()
+
+    @property
+    def session(self):
+        """The requests.Session, created on first use."""
+        if self._session is None:
+            import requests
+
+            with self.lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=self.pool_size,
+                        pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    if not self.compression:
+                        session.headers['Accept-Encoding'] = 'identity'
+                    self._session = session
+        return self._session
+
+    @contextmanager
+    def caching(self, enabled=True):
+        """Lets the GETs of the current thread use the cache, or not."""
+        previous = getattr(self._caching, 'enabled', False)
+        self._caching.enabled = enabled
+        try:
+            yield
+        finally:
+            self._caching.enabled = previous
+
+    def invalidate(self):
+        if self.cache is not None:
+            with self.lock:
+                self.cache.clear()
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        method = method.upper()
+        if self.cache is None or method != 'GET' or \
+                not getattr(self._caching, 'enabled', False):
+            if method in self.IDEMPOTENT:
+                return self._send(method, url, **kwargs)
+            self.invalidate()
+            try:
+                return self._send(method, url, **kwargs)
+            finally:
+                # and again, lest a GET racing with this one cached the
+                # state from before
+                self.invalidate()
+
+        key = json.dumps([url, kwargs.get('params'), kwargs.get('headers'),
+                          kwargs.get('data')], sort_keys=True, default=str)
+        with self.lock:
+            cached = self.cache.get(key)
+        if cached is not None:
+            validators = {}
+            if cached.headers.get('ETag'):
+                validators['If-None-Match'] = cached.headers['ETag']
+            if cached.headers.get('Last-Modified'):
+                validators['If-Modified-Since'] = \
+                    cached.headers['Last-Modified']
+            if not validators:
+                self.hits += 1
+                return cached
+            kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                     **validators)
+
+        response = self._send(method, url, **kwargs)
+        if cached is not None and response.status_code == 304:
+            self.revalidations += 1
+            return cached
+        if response.status_code == 200:
+            with self.lock:
+                self.cache[key] = response
+        return response
+
+    def _send(self, method, url, **kwargs):
+        return self.session.request(method, url, **kwargs)
+
+
+_http_sessions = local()
+
+
+@contextmanager
+def _using_http_session(session):
+    previous = getattr(_http_sessions, 'session', None)
+    _http_sessions.session = session
+    try:
+        yield
+    finally:
+        _http_sessions.session = previous
+
+
+def _routed(method, *params):
+    # The functions of requests.api, which take these params positionally
+    def request(self, url, *args, **kwargs):
+        session = getattr(_http_sessions, 'session', None)
+        if session is None:
+            return getattr(self._module, method.lower())(url, *args,
+                                                         **kwargs)
+        kwargs.update(zip(params, args))
+        if method == 'HEAD':
+            kwargs.setdefault('allow_redirects', False)
+        return session.request(method, url, **kwargs)
+    return request
+
+
+class _SessionRoutedRequests:
+    """Stands in for the requests module in the module of a lexicon provider.
+
+    Most lexicon providers call requests.request, requests.get and the like
+    rather than holding a session, so this sends those calls to the session
+    of the client calling the provider in the current thread, if any.
+    Everything else is the requests module itself.
+    """
+
+    def __init__(self, module):
+        self._module = module
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+    def request(self, method, url, **kwargs):
+        session = getattr(_http_sessions, 'session', None)
+        if session is None:
+            return self._module.request(method, url, **kwargs)
+        return session.request(method, url, **kwargs)
+
+    get = _routed('GET', 'params')
+    head = _routed('HEAD')
+    options = _routed('OPTIONS')
+    post = _routed('POST', 'data', 'json')
+    put = _routed('PUT', 'data')
+    patch = _routed('PATCH', 'data')
+    delete = _routed('DELETE')
+
+
+def _route_requests(provider):
+    import requests
+
+    module = sys.modules.get(type(provider).__module__)
+    if getattr(module, 'requests', None) is requests:
+        module.requests = _SessionRoutedRequests(requests)
+
+
+class LexiconClientCache:
+    """LRU cache of authenticated clients, with an idle expiry."""
+
+    def __init__(self, max_size=32, idle_expiry=900):
+        self.lock = Lock()
+        self.max_size = max_size
+        self.idle_expiry = idle_expiry
+        self._clients = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            client = self._clients.get(key)
+            if client is None:
+                return None
+            now = time.monotonic()
+            if self.idle_expiry is not None and \
+                    now - client.last_used > self.idle_expiry:
+                del self._clients[key]
+                return None
+            client.last_used = now
+            self._clients.move_to_end(key)
+            return client
+
+    def put(self, key, client):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self._clients[key] = client
+            self._clients.move_to_end(key)
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self._clients.clear()
+
+    def __len__(self):
+        return len(self._clients)
+
+
+class ZoneSnapshotCache:
+    """Listings of zones, kept in a sqlite file across runs.
+
+    A snapshot is served for ttl seconds after the zone was listed. Updating
+    it from applied changes does not make it any fresher, since the rest of
+    the zone has not been looked at since.
+    """
+
+    def __init__(self, path, ttl=300):
+        import sqlite3
+
+        self.lock = Lock()
+        self.ttl = ttl
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS snapshots ('
+                            'account TEXT, zone TEXT, listed REAL, '
+                            'records TEXT, PRIMARY KEY (account, zone))')
+
+    def get(self, account, zone_name):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT listed, records FROM snapshots '
+                'WHERE account = ? AND zone = ?',
+                (account, zone_name)).fetchone()
+        if row is None or time.time() - row[0] >= self.ttl:
+            return None
+        return json.loads(row[1])
+
+    def put(self, account, zone_name, records, keep_age=False):
+        records = json.dumps(records, separators=(',', ':'), default=str)
+        with self.lock, self.db:
+            if keep_age:
+                self.db.execute(
+                    'UPDATE snapshots SET records = ? '
+                    'WHERE account = ? AND zone = ?',
+                    (records, account, zone_name))
+            else:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)',
+                    (account, zone_name, time.time(), records))
+
+    def invalidate(self, account, zone_name):
+        with self.lock, self.db:
+            self.db.execute(
+                'DELETE FROM snapshots WHERE account = ? AND zone = ?',
+                (account, zone_name))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class ZoneStateCache:
+    """Listings of zones, kept in memory for the life of the provider.
+
+    The same as ZoneSnapshotCache, short of the file: a listing is served
+    for ttl seconds after the zone was listed. Listings are copied in and
+    out, as populate consumes the ones it is handed.
+    """
+
+    def __init__(self, ttl):
+        self.lock = Lock()
+        self.ttl = ttl
+        self._states = {}
+
+    def get(self, account, zone_name):
+        with self.lock:
+            state = self._states.get((account, zone_name))
+        if state is None or time.monotonic() - state[0] >= self.ttl:
+            return None
+        return [dict(r) for r in state[1]]
+
+    def put(self, account, zone_name, records, keep_age=False):
+        records = [dict(r) for r in records]
+        with self.lock:
+            state = self._states.get((account, zone_name)) \
+                if keep_age else None
+            listed = state[0] if state else time.monotonic()
+            self._states[(account, zone_name)] = (listed, records)
+
+    def invalidate(self, account, zone_name):
+        with self.lock:
+            self._states.pop((account, zone_name), None)
+
+
+class ApplyJournal:
+    """Append-only log of the operations of an _apply, one JSON per line.
+
+    The operations to apply are logged first, then every operation as it
+    is started and as it is done, flushed to disk before going on. The
+    file is removed once the _apply completes, so a journal left behind
+    tells of an _apply which was interrupted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+
+    @staticmethod
+    def key(operation):
+        action, record, identifier = operation
+        return json.dumps([action, record.content, record.ttl, record.rtype,
+                           record.name, identifier], default=str)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def entries(self):
+        try:
+            with open(self.path) as fh:
+                lines = fh.readlines()
+        except FileNotFoundError:
+            return []
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # the line being written when the process died
+                break
+        return entries
+
+    def begin(self, operations):
+        """Start journaling operations, resuming the journal left by an
+        earlier attempt at the same operations, if any.
+
+            :type return: keys of the operations started and done before
+        """
+        keys = [self.key(o) for change_operations in operations
+                for o in change_operations]
+        fingerprint = hashlib.sha256(
+            '\n'.join(keys).encode('utf-8')).hexdigest()
+        entries = self.entries()
+        if entries and entries[0].get('fingerprint') == fingerprint:
+            started = {e['key'] for e in entries[1:]}
+            done = {e['key'] for e in entries[1:] if e['event'] == 'done'}
+            return started, done
+
+        with open(self.path, 'w') as fh:
+            json.dump({'event': 'plan', 'fingerprint': fingerprint,
+                       'operations': keys}, fh)
+            fh.write('\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+        return set(), set()
+
+    def append(self, event, operation):
+        line = json.dumps({'event': event, 'key': self.key(operation),
+                           'time': time.time()}) + '\n'
+        with self.lock, open(self.path, 'a') as fh:
+            fh.write(line)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def touched(self):
+        """(type, lexicon name) of the rrsets of the operations started."""
+        touched = set()
+        for entry in self.entries()[1:]:
+            _, _, _, rtype, name, _ = json.loads(entry['key'])
+            touched.add((rtype, name))
+        return touched
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class TokenBucket:
+    """Token bucket allowing rate calls per second, in bursts of burst."""
+
+    _by_account = {}
+    _by_account_lock = Lock()
+
+    def __init__(self, rate, burst=None):
+        self.lock = Lock()
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    @classmethod
+    def for_account(cls, account, rate, burst=None):
+        """Get the bucket shared by everything using the same account, and
+        the same rate and burst."""
+        key = (account, rate, burst)
+        with cls._by_account_lock:
+            if key not in cls._by_account:
+                cls._by_account[key] = cls(rate, burst)
+            return cls._by_account[key]
+
+    def acquire(self):
+        """Take one token, sleeping until there is one available.
+
+        Returns the number of seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on the number of provider calls in flight.
+
+    The limit grows by one once about as many calls as the limit allows
+    completed in good health: without error, and no slower than
+    latency_tolerance times the fastest call of the same action seen so far.
+    It only grows while calls actually queue up against it. A transient
+    error (429, server error, connection error or timeout) cuts it by
+    backoff, once per round: calls started before the last cut do not cut
+    it again.
+    """
+
+    _by_account = {}
+    _by_account_lock = Lock()
+
+    def __init__(self, max_limit, initial=1, latency_tolerance=2,
+                 backoff=0.5, min_limit=1):
+        self.condition = Condition()
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.limit = float(max(self.min_limit, min(int(initial),
+                                                   self.max_limit)))
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.in_flight = 0
+        self.round = 0
+        self.fastest = {}
+        self.increases = 0
+        self.decreases = 0
+
+    @classmethod
+    def for_account(cls, account, max_limit, initial=1, latency_tolerance=2):
+        """Get the limit shared by everything using the same account, and
+        the same max_limit and latency_tolerance. initial only matters to
+        the first one asking."""
+        key = (account, max_limit, latency_tolerance)
+        with cls._by_account_lock:
+            if key not in cls._by_account:
+                cls._by_account[key] = cls(max_limit, initial,
+                                           latency_tolerance)
+            return cls._by_account[key]
+
+    def acquire(self):
+        """Wait for the number of calls in flight to be under the limit,
+        and count one more.
+
+            :type return: the ticket to hand back to release
+        """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            return self.round
+
+    def release(self, ticket, action, seconds, error=None):
+        """Count a call done, and adjust the limit from how it went."""
+        with self.condition:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if error is not None:
+                if _is_transient_error(error) and ticket == self.round:
+                    self._decrease()
+            else:
+                fastest = self.fastest.get(action, seconds)
+                # creeps up, so that a backend getting slower for good
+                # does not stop the limit from ever growing again
+                self.fastest[action] = min(seconds, fastest * 1.01)
+                if saturated and seconds <= fastest * self.latency_tolerance:
+                    self._increase()
+            self.condition.notify_all()
+
+    def _increase(self):
+        before = int(self.limit)
+        self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+        if int(self.limit) > before:
+            self.increases += 1
+
+    def _decrease(self):
+        limit = max(float(self.min_limit), self.limit * self.backoff)
+        self.round += 1
+        if int(limit) < int(self.limit):
+            self.decreases += 1
+        self.limit = limit
+
+    def state(self):
+        """The limit, calls in flight, and what the limit was adjusted
+        from, for inspection."""
+        with self.condition:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'max_limit': self.max_limit,
+                'min_limit': self.min_limit,
+                'increases': self.increases,
+                'decreases': self.decreases,
+                'fastest': dict(self.fastest),
+            }
+
+
+class ProviderMetrics:
+    """Counts and times the calls made to a lexicon provider.
+
+    Calls are accounted per (action, zone, record type), with a latency
+    histogram, and errors per status code (or exception name, or 'false'
+    for falsy returns). Retries are counted separately.
+    """
+
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, provider_id, textfile=None, callback=None):
+        self.log = logging.getLogger('ProviderMetrics[{}]'.format(
+            provider_id))
+        self.lock = Lock()
+        self.provider_id = provider_id
+        self.textfile = textfile
+        if isinstance(callback, str):
+            module_name, _, func_name = callback.partition(':')
+            callback = getattr(import_module(module_name), func_name)
+        self.callback = callback
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.buckets = defaultdict(lambda: [0] * len(self.BUCKETS))
+        self.errors = defaultdict(int)
+        self.retries = defaultdict(int)
+
+    @staticmethod
+    def _error_label(error):
+        if error is False:
+            return 'false'
+        return str(_status_code(error) or type(error).__name__)
+
+    def observe(self, action, zone, rtype, seconds, error=None):
+        key = (action, zone, rtype or '')
+        with self.lock:
+            self.calls[key] += 1
+            self.seconds[key] += seconds
+            bucket = bisect_left(self.BUCKETS, seconds)
+            if bucket < len(self.BUCKETS):
+                self.buckets[key][bucket] += 1
+            if error is not None:
+                self.errors[key + (self._error_label(error),)] += 1
+        if self.callback is not None:
+            # a broken exporter must not fail the call it reports on
+            try:
+                self.callback({
+                    'provider': self.provider_id,
+                    'action': action,
+                    'zone': zone,
+                    'rtype': rtype,
+                    'seconds': seconds,
+                    'error': None if error is None
+                    else self._error_label(error)
+                })
+            except Exception as e:
+                self.log.warning('observe: metrics callback failed: %r', e)
+
+    def retry(self, action, zone, rtype):
+        with self.lock:
+            self.retries[(action, zone, rtype or '')] += 1
+
+    def _labels(self, key, **extra):
+        labels = [('provider', self.provider_id)] + \
+            list(zip(('action', 'zone', 'rtype'), key)) + \
+            list(extra.items())
+        return ','.join('{}="{}"'.format(
+            name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n')) for name, value in labels)
+
+    def prometheus_text(self):
+        """The metrics, in the prometheus text exposition format."""
+        prefix = 'octodns_lexicon_'
+        lines = []
+        with self.lock:
+            lines.append('# HELP {}calls_total Lexicon provider calls.'
+                         .format(prefix))
+            lines.append('# TYPE {}calls_total counter'.format(prefix))
+            for key, count in sorted(self.calls.items()):
+                lines.append('{}calls_total{{{}}} {}'.format(
+                    prefix, self._labels(key), count))
+
+            lines.append('# HELP {}call_errors_total Failed lexicon '
+                         'provider calls.'.format(prefix))
+            lines.append('# TYPE {}call_errors_total counter'.format(prefix))
+            for key, count in sorted(self.errors.items()):
+                lines.append('{}call_errors_total{{{}}} {}'.format(
+                    prefix, self._labels(key[:3], error=key[3]), count))
+
+            lines.append('# HELP {}call_retries_total Retried lexicon '
+                         'provider calls.'.format(prefix))
+            lines.append('# TYPE {}call_retries_total counter'.format(prefix))
+            for key, count in sorted(self.retries.items()):
+                lines.append('{}call_retries_total{{{}}} {}'.format(
+                    prefix, self._labels(key), count))
+
+            lines.append('# HELP {}call_duration_seconds Latency of lexicon '
+                         'provider calls.'.format(prefix))
+            lines.append('# TYPE {}call_duration_seconds histogram'
+                         .format(prefix))
+            for key, count in sorted(self.calls.items()):
+                labels = self._labels(key)
+                cumulative = 0
+                for le, n in zip(self.BUCKETS, self.buckets[key]):
+                    cumulative += n
+                    lines.append('{}call_duration_seconds_bucket{{{},le="{}"}}'
+                                 ' {}'.format(prefix, labels, le, cumulative))
+                lines.append('{}call_duration_seconds_bucket{{{},le="+Inf"}}'
+                             ' {}'.format(prefix, labels, count))
+                lines.append('{}call_duration_seconds_sum{{{}}} {}'.format(
+                    prefix, labels, self.seconds[key]))
+                lines.append('{}call_duration_seconds_count{{{}}} {}'.format(
+                    prefix, labels, count))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """Write the metrics to the textfile, if there is one."""
+        if not self.textfile:
+            return
+        # written aside and renamed, so that a collector never reads half
+        # a file
+        tmp = '{}.{}.tmp'.format(self.textfile, os.getpid())
+        with open(tmp, 'w') as fh:
+            fh.write(self.prometheus_text())
+        os.replace(tmp, self.textfile)
+
+
+class SpanTracer:
+    """Records spans around the phases of populate and _apply.
+
+    Spans are kept as Chrome trace events until flush appends them to
+    trace_file, and passed on to hook, if any, as they start. Attributes
+    set on a span once it started are passed on with set_attribute, where
+    the context hook returned has one.
+    """
+
+    # written after the events, and over again by the next flush
+    TAIL = b'\n], "displayTimeUnit": "ms"}\n'
+
+    def __init__(self, provider_id, trace_file=None, hook=None):
+        self.lock = Lock()
+        self.provider_id = provider_id
+        self.trace_file = trace_file
+        if isinstance(hook, str):
+            module_name, _, func_name = hook.partition(':')
+            hook = getattr(import_module(module_name), func_name)
+        self.hook = hook
+        self.events = []
+        # where the next events go in trace_file, once it was started
+        self._end = None
+        self._written = 0
+
+    def span(self, name, attributes):
+        attributes['provider'] = self.provider_id
+        return _Span(self, name, attributes)
+
+    def record(self, name, start, end, attributes):
+        if not self.trace_file:
+            return
+        event = {'name': name, 'cat': 'octodns_lexicon', 'ph': 'X',
+                 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                 'pid': os.getpid(), 'tid': get_ident(),
+                 'args': attributes}
+        with self.lock:
+            self.events.append(event)
+
+    def flush(self):
+        """Append the spans recorded since the last flush to the
+        trace_file, if there is one, which is left a complete trace."""
+        if not self.trace_file:
+            return
+        with self.lock:
+            events, self.events = self.events, []
+            if self._end is None:
+                fh = open(self.trace_file, 'wb')
+                fh.write(b'{"traceEvents": [')
+            else:
+                fh = open(self.trace_file, 'r+b')
+                fh.seek(self._end)
+            with fh:
+                for event in events:
+                    fh.write(b',\n' if self._written else b'\n')
+                    fh.write(json.dumps(event, default=str).encode('utf-8'))
+                    self._written += 1
+                self._end = fh.tell()
+                fh.write(self.TAIL)
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'attributes', 'start', 'context',
+                 'hooked')
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.context = None
+        self.hooked = None
+
+    def __enter__(self):
+        if self.tracer.hook is not None:
+            self.context = self.tracer.hook(
+                self.name, attributes=dict(self.attributes))
+            self.hooked = self.context.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        set_attribute = getattr(self.hooked, 'set_attribute', None)
+        if set_attribute is not None:
+            for key, value in attributes.items():
+                set_attribute(key, value)
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.attributes.setdefault('error', exc_type.__name__)
+        self.tracer.record(self.name, self.start, end, self.attributes)
+        if self.context is not None:
+            return self.context.__exit__(exc_type, exc, tb)
+        return False
+
+
+class _NoSpan:
+    # handed out by LexiconProvider._span while tracing is off
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+LexiconOperation = namedtuple('LexiconOperation', 'action record identifier')
 
 
 class LexiconRecord(namedtuple('LexiconRecord', 'content ttl rtype name')):
@@ -447,15 +2419,35 @@ class LexiconRecord(namedtuple('LexiconRecord', 'content ttl rtype name')):
         return {k: getattr(self, k) for k in ['content', 'rtype', 'name']}
 
 
-class OnTheFlyLexiconConfigSource(LexiconConfigSource):
+class OnTheFlyLexiconConfigSource:
+    # A lexicon.config.ConfigSource, which is only an interface, not
+    # subclassed so that lexicon need not be imported along with this module
 
     def __init__(self, domain, ttl=3600):
-        super(OnTheFlyLexiconConfigSource, self).__init__()
-        self.ttl = ttl
+        self.default_ttl = ttl
         self.domain = domain
+        self._local = local()
+
+    @property
+    def ttl(self):
+        # TTL is tracked per thread so that operations running concurrently
+        # on the same client do not overwrite each others TTL.
+        return getattr(self._local, 'ttl', self.default_ttl)
 
     def set_ttl(self, ttl):
-        self.ttl = ttl
+        self._local.ttl = ttl
+
+    @contextmanager
+    def using_ttl(self, ttl):
+        previous = getattr(self._local, 'ttl', None)
+        self._local.ttl = ttl
+        try:
+            yield
+        finally:
+            if previous is None:
+                del self._local.ttl
+            else:
+                self._local.ttl = previous
 
     def resolve(self, config_key):
         if config_key == "lexicon:ttl":
@@ -473,6 +2465,360 @@ class OnTheFlyLexiconConfigSource(LexiconConfigSource):
             return None
 
 
+SimulatedClient = namedtuple('SimulatedClient', 'provider')
+
+
+class SimulatedStore:
+
+    def __init__(self):
+        self.zones = {}
+        # the calls of the last second, to every zone of the store
+        self.lock = Lock()
+        self.window = deque()
+
+
+class SimulatedProvider:
+    """In-memory stand-in for a lexicon provider, to load test offline.
+
+    Records live in a store shared by every SimulatedProvider using the
+    same store name, so that populate and _apply see the same zones.
+
+        latency: mean latency of a call, in seconds (default: 0)
+        latency_jitter: standard deviation of the latency (default: 0)
+        error_rate: fraction of calls failing with a 500 (default: 0)
+        lost_response_rate: fraction of mutations which are carried out, yet
+                fail with a 502 (default: 0)
+        rate_limit: calls per second over which calls fail with a 429,
+                counted across every zone of the store, as APIs throttle
+                per account (default: unlimited)
+        unique_ids: whether each record gets an id of its own. If false,
+                ids are derived from record names, like Gandi does
+                (default: true)
+        ttl_updates: whether update_record changes the TTL (default: true)
+        store: name of the store holding the zones (default: 'default')
+        records: records to seed the zone with, if it is not in the store
+                yet, as lexicon dicts of type, name, content and ttl
+        seed: seed of the random number generator
+    """
+
+    _stores = defaultdict(SimulatedStore)
+    _stores_lock = Lock()
+
+    def __init__(self, config, latency=0, latency_jitter=0, error_rate=0,
+                 lost_response_rate=0, rate_limit=None, unique_ids=True,
+                 ttl_updates=True, store='default', records=None,
+                 seed=None):
+        self.config = config
+        self.domain = config.resolve('lexicon:domain')
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.lost_response_rate = lost_response_rate
+        self.rate_limit = rate_limit
+        self.unique_ids = unique_ids
+        self.ttl_updates = ttl_updates
+        self.random = random.Random(seed)
+        self.calls = defaultdict(int)
+
+        with self._stores_lock:
+            self.store = self._stores[store]
+            zones = self.store.zones
+            if self.domain not in zones:
+                zones[self.domain] = SimulatedZone()
+            self.zone = zones[self.domain]
+        with self.zone.lock:
+            for record in records or ():
+                self._add(record['type'], record['name'],
+                          record['content'], record.get('ttl', 3600))
+
+    @classmethod
+    def reset(cls, store=None):
+        """Empty one store, or all of them."""
+        with cls._stores_lock:
+            if store is None:
+                cls._stores.clear()
+            else:
+                cls._stores.pop(store, None)
+
+    def _full_name(self, name):
+        name = name.rstrip('.')
+        if name == '@' or name == '@.' + self.domain:
+            return self.domain
+        if name != self.domain and not name.endswith('.' + self.domain):
+            name = '{}.{}'.format(name, self.domain)
+        return name
+
+    def _id(self, full_name):
+        if self.unique_ids:
+            self.zone.last_id += 1
+            return str(self.zone.last_id)
+        return full_name[:-len(self.domain)].rstrip('.') or '@'
+
+    def _add(self, rtype, name, content, ttl):
+        full_name = self._full_name(name)
+        for record in self.zone.records:
+            if (record['type'], record['name'], record['content']) == \
+                    (rtype, full_name, content):
+                return
+        self.zone.records.append({'type': rtype, 'name': full_name,
+                                  'ttl': ttl, 'content': content,
+                                  'id': self._id(full_name)})
+
+    def _matches(self, record, rtype, name, content):
+        return (rtype is None or record['type'] == rtype) and \
+            (name is None or record['name'] == self._full_name(name)) and \
+            (content is None or record['content'] == content)
+
+    def _request(self, action, mutation=False):
+        """Simulate the latency and failures of one request."""
+
+        def error(status_code):
+            import requests
+
+            response = requests.Response()
+            response.status_code = status_code
+            return requests.exceptions.HTTPError(
+                '{} simulated'.format(status_code), response=response)
+
+        with self.zone.lock:
+            self.calls[action] += 1
+            if self.rate_limit:
+                with self.store.lock:
+                    now = time.monotonic()
+                    window = self.store.window
+                    while window and now - window[0] >= 1:
+                        window.popleft()
+                    if len(window) >= self.rate_limit:
+                        raise error(429)
+                    window.append(now)
+            failed = self.random.random() < self.error_rate
+            lost = mutation and \
+                self.random.random() < self.lost_response_rate
+            delay = max(0.0, self.random.gauss(self.latency,
+                                               self.latency_jitter))
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise error(500)
+        return error(502) if lost else None
+
+    def authenticate(self):
+        self._request('authenticate')
+
+    def list_records(self, rtype=None, name=None, content=None):
+        self._request('list_records')
+        with self.zone.lock:
+            return [dict(r) for r in self.zone.records
+                    if self._matches(r, rtype, name, content)]
+
+    def create_record(self, rtype, name, content):
+        lost = self._request('create_record', mutation=True)
+        with self.zone.lock:
+            self._add(rtype, name, content,
+                      self.config.resolve('lexicon:ttl'))
+        if lost:
+            raise lost
+        return True
+
+    def update_record(self, identifier, rtype=None, name=None,
+                      content=None):
+        lost = self._request('update_record', mutation=True)
+        with self.zone.lock:
+            for record in self.zone.records:
+                if (identifier and record['id'] == identifier) or \
+                        (not identifier and
+                         self._matches(record, rtype, name, None)):
+                    record['content'] = content
+                    if self.ttl_updates:
+                        record['ttl'] = self.config.resolve('lexicon:ttl')
+                    break
+            else:
+                return False
+        if lost:
+            raise lost
+        return True
+
+    def delete_record(self, identifier=None, rtype=None, name=None,
+                      content=None):
+        lost = self._request('delete_record', mutation=True)
+        with self.zone.lock:
+            if identifier:
+                # without unique ids, that is every record of the name
+                keep = [r for r in self.zone.records
+                        if r['id'] != identifier]
+            else:
+                keep = [r for r in self.zone.records
+                        if not self._matches(r, rtype, name, content)]
+            self.zone.records[:] = keep
+        if lost:
+            raise lost
+        return True
+
+
+class SimulatedZone:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.records = []
+        self.last_id = 0
+
+
+_sync_manager = None
+
+
+def _init_sync_worker(config_file):
+    from octodns.manager import Manager
+
+    global _sync_manager
+    _sync_manager = Manager(config_file, max_workers=1)
+
+
+def _sync_zone(zone_name, dry_run, force):
+    start = time.monotonic()
+    try:
+        applied = _sync_manager.sync(eligible_zones=[zone_name],
+                                     dry_run=dry_run, force=force)
+    except Exception as e:
+        logging.getLogger('octodns-lexicon-sync').exception(
+            'sync of %s failed', zone_name)
+        return _failed_zone(zone_name, e, time.monotonic() - start)
+    return {'zone': zone_name, 'applied': applied,
+            'seconds': round(time.monotonic() - start, 3), 'error': None}
+
+
+def _failed_zone(zone_name, error, seconds=0):
+    return {'zone': zone_name, 'applied': 0, 'seconds': round(seconds, 3),
+            'error': '{}: {}'.format(type(error).__name__, error)}
+
+
+def _zone_accounts(manager):
+    """The lexicon accounts each zone of manager is synced to, keyed by
+    their lexicon config."""
+    accounts = {}
+    for zone_name, zone_config in manager.config['zones'].items():
+        accounts[zone_name] = {
+            manager.providers[target]._config_key
+            for target in zone_config.get('targets', [])
+            if isinstance(manager.providers.get(target), LexiconProvider)}
+    return accounts
+
+
+def _sync_fleet(executor, zone_accounts, max_in_flight, account_concurrency,
+                dry_run, force):
+    """Sync the zones of zone_accounts with executor, keeping at most
+    max_in_flight zones submitted, and at most account_concurrency zones
+    of one account in flight, wherever they run."""
+    pending = deque(sorted(zone_accounts))
+    in_flight = defaultdict(int)
+    running = {}
+    results = []
+    while pending or running:
+        for _ in range(len(pending)):
+            zone_name = pending.popleft()
+            accounts = zone_accounts[zone_name]
+            if len(running) >= max_in_flight or any(
+                    in_flight[a] >= account_concurrency for a in accounts):
+                pending.append(zone_name)
+                continue
+            try:
+                future = executor.submit(_sync_zone, zone_name, dry_run,
+                                         force)
+            except BrokenExecutor as e:
+                # a worker died, no zone can be synced any more
+                results.append(_failed_zone(zone_name, e))
+                continue
+            for account in accounts:
+                in_flight[account] += 1
+            running[future] = zone_name
+
+        if not running:
+            continue
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            zone_name = running.pop(future)
+            for account in zone_accounts[zone_name]:
+                in_flight[account] -= 1
+            try:
+                results.append(future.result())
+            except BrokenExecutor as e:
+                results.append(_failed_zone(zone_name, e))
+    return sorted(results, key=lambda r: r['zone'])
+
+
+def main():
+    """octodns-lexicon-sync: octodns-sync, sharded over processes."""
+    from concurrent.futures import ProcessPoolExecutor
+    from octodns.cmds.args import ArgumentParser
+    from octodns.manager import Manager
+
+    parser = ArgumentParser(description='Sync many zones with octoDNS, in '
+                            'parallel worker processes')
+    parser.add_argument('--config-file', required=True,
+                        help='The Manager configuration file to use')
+    parser.add_argument('--doit', action='store_true', default=False,
+                        help='Whether to take action or just show what '
+                        'would change')
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='Acknowledge that significant changes are '
+                        'being made and do them')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='Number of worker processes (default: number '
+                        'of CPUs, 1 syncs in this process)')
+    parser.add_argument('--account-concurrency', type=int, default=4,
+                        help='Max number of zones of one lexicon account '
+                        'synced at once (default: 4)')
+    parser.add_argument('--report', default=None,
+                        help='File to write a JSON report of the results '
+                        'to')
+    parser.add_argument('zone', nargs='*', default=[],
+                        help='Limit sync to the specified zone(s)')
+    args = parser.parse_args()
+
+    zone_accounts = _zone_accounts(Manager(args.config_file, max_workers=1))
+    if args.zone:
+        unknown = [z for z in args.zone if z not in zone_accounts]
+        if unknown:
+            parser.error('Requested zone(s) not found in config: {}'
+                         .format(', '.join(unknown)))
+        zone_accounts = {z: zone_accounts[z] for z in args.zone}
+
+    processes = max(1, args.processes)
+    executor_class = ProcessPoolExecutor if processes > 1 \
+        else ThreadPoolExecutor
+    start = time.monotonic()
+    with executor_class(max_workers=processes, initializer=_init_sync_worker,
+                        initargs=(args.config_file,)) as executor:
+        results = _sync_fleet(executor, zone_accounts, processes,
+                              max(1, args.account_concurrency),
+                              not args.doit, args.force)
+
+    failed = [r for r in results if r['error']]
+    report = {
+        'zones': len(results),
+        'failed': len(failed),
+        'applied': sum(r['applied'] for r in results),
+        'seconds': round(time.monotonic() - start, 3),
+        'results': results
+    }
+    for result in failed:
+        print('FAILED {zone}: {error}'.format(**result), file=sys.stderr)
+    print('{zones} zones, {failed} failed, {applied} changes applied in '
+          '{seconds}s'.format(**report), file=sys.stderr)
+    if args.report:
+        with open(args.report, 'w') as fh:
+            json.dump(report, fh, indent=2)
+    return 1 if failed else 0
+
+
+class ApiCallBudgetExceeded(RuntimeError):
+    def __init__(self, estimate, max_api_calls):
+        msg = "Plan for {} needs {} provider calls {!s}, max_api_calls is " \
+              "{}".format(estimate['zone'], estimate['total'],
+                          estimate['by_action'], max_api_calls)
+        super(ApiCallBudgetExceeded, self).__init__(msg)
+        self.estimate = estimate
+
+
 class RecordUpdateError(RuntimeError):
     def __init__(self, record, identifier=None):
         msg = "Error handling record: {!s} id:{!s}".format(record, identifier)
@@ -1,13 +1,35 @@
+import asyncio
+import json
+import shlex
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from os import listdir
+from os.path import abspath, dirname, exists, join
+from tempfile import TemporaryDirectory
+from threading import Lock, Thread
 from unittest import TestCase
 from unittest.mock import Mock, call, patch
 
 from octodns.provider.plan import Plan
+from requests.exceptions import HTTPError
 from octodns.record import Record, Create, Delete, Update
 from octodns.zone import Zone
+import requests
+from requests import Session
 
+import octodns_lexicon
 from octodns_lexicon import \
     LexiconProvider, OnTheFlyLexiconConfigSource, RecordUpdateError, \
-    RecordCreateError, RecordDeleteError, RememberedIds
+    RecordCreateError, RecordDeleteError, RememberedIds, LexiconClientCache, \
+    TokenBucket, LexiconRecordGroups, _consume, CONTENT_CODECS, _last_token, \
+    SimulatedProvider, ProviderMetrics, BULK_ADAPTERS, BulkAdapter, \
+    register_bulk_adapter, ApiCallBudgetExceeded, ZoneSnapshotCache, main, \
+    _sync_fleet, PooledHttpSession, CachedLexiconClient, _route_requests, \
+    _using_http_session, ApplyJournal, ZoneStateCache, AdaptiveConcurrency
 
 LEXICON_DATA = [
     {'type': 'A', 'name': '@.blodapels.in', 'ttl': 10800, 'content':
@@ -104,6 +126,25 @@ lexicon_config = {
 }
 
 
+class TestLazyImports(TestCase):
+
+    def test_import_defers_run_time_dependencies(self):
+        # Given
+        deferred = ('lexicon', 'requests', 'asyncio', 'sqlite3',
+                    'multiprocessing')
+        script = 'import sys, octodns_lexicon; print(",".join(' \
+            'm for m in {!r} if m in sys.modules))'.format(deferred)
+
+        # When
+        done = subprocess.run([sys.executable, '-c', script],
+                              cwd=dirname(abspath(__file__)),
+                              capture_output=True, text=True, check=True)
+
+        # Then
+        self.assertEqual(done.stdout.strip(), '',
+                         "importing octodns_lexicon loads none of them")
+
+
 class TestLexiconProvider(TestCase):
 
     @patch('lexicon.providers.gandi.Provider.list_records',
@@ -455,10 +496,12 @@ class TestLexiconProviderApplyScenarios(TestCase):
                  name='test-many.blodapels.in.')]
 
         expected_calls_for_delete = [
-            call(content='192.168.2.3',
+            call(identifier=None,
+                 content='192.168.2.3',
                  rtype='A',
                  name='test-many.blodapels.in.'),
-            call(content='192.168.2.4',
+            call(identifier=None,
+                 content='192.168.2.4',
                  rtype='A',
                  name='test-many.blodapels.in.')]
 
@@ -633,3 +676,2399 @@ class TestLexiconProviderApplyScenarios(TestCase):
         # Then
         with self.assertRaises(RecordDeleteError):
             self.provider._apply(plan)
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_apply_concurrent(self, provider_mock):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   max_workers=4)
+        provider_mock.return_value = self.provider_mock
+        ttls = {}
+
+        def create_record(rtype, name, content):
+            ttls[(rtype, name, content)] = \
+                provider_mock.call_args[0][0].resolve('lexicon:ttl')
+            return True
+
+        self.provider_mock.create_record.side_effect = create_record
+        changeset = [Create(r) for r in OCTODNS_DATA]
+        changeset.append(Create(Record.new(ZONE, 'short-ttl', {
+            'ttl': 60, 'type': 'A', 'values': ['10.0.0.1']})))
+        plan = Plan(ZONE, ZONE, changeset, True)
+
+        # When
+        provider._apply(plan)
+
+        # Then
+        self.assertEqual(self.provider_mock.create_record.call_count, 14)
+        self.assertEqual(ttls[('A', 'short-ttl.blodapels.in.', '10.0.0.1')],
+                         60, "TTL is resolved per operation")
+        self.assertEqual(ttls[('A', '@.blodapels.in.', '192.0.184.38')],
+                         10800, "TTL is resolved per operation")
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_apply_concurrent_same_name_in_order(self, provider_mock):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   max_workers=4, bulk_operations=False)
+        calls = []
+
+        def delete_record(identifier=None, rtype=None, name=None,
+                          content=None):
+            # a slow delete, which a concurrent create would overtake
+            time.sleep(0.05)
+            calls.append(('delete', rtype, name))
+            return True
+
+        def create_record(rtype, name, content):
+            calls.append(('create', rtype, name))
+            return True
+
+        provider_mock.return_value.delete_record.side_effect = delete_record
+        provider_mock.return_value.create_record.side_effect = create_record
+        a = Record.new(ZONE, 'www', {'ttl': 300, 'type': 'A',
+                                     'value': '10.0.0.1'})
+        cname = Record.new(ZONE, 'www', {'ttl': 300, 'type': 'CNAME',
+                                         'value': 'target.example.com.'})
+        other = Record.new(ZONE, 'other', {'ttl': 300, 'type': 'A',
+                                           'value': '10.0.0.2'})
+        plan = Plan(ZONE, ZONE, [Delete(a), Create(cname), Create(other)],
+                    True)
+
+        # When
+        provider._apply(plan)
+
+        # Then
+        www = [c for c in calls if c[2] == 'www.blodapels.in.']
+        self.assertEqual(www, [('delete', 'A', 'www.blodapels.in.'),
+                               ('create', 'CNAME', 'www.blodapels.in.')])
+        self.assertEqual(calls[0], ('create', 'A', 'other.blodapels.in.'),
+                         "other names do not wait")
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_apply_concurrent_error(self, provider_mock):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   max_workers=2)
+        provider_mock.return_value.create_record.return_value = False
+        changeset = [Create(r) for r in OCTODNS_DATA]
+        plan = Plan(ZONE, ZONE, changeset, True)
+
+        # Then
+        with self.assertRaises(RecordCreateError):
+            provider._apply(plan)
+
+    def test_config_resolver_ttl_per_thread(self):
+        # Given
+        config_resolver = OnTheFlyLexiconConfigSource(domain="fiskppinne.")
+        seen = []
+
+        def resolve_in_thread():
+            seen.append(config_resolver.resolve("lexicon:ttl"))
+
+        # When
+        with config_resolver.using_ttl(300):
+            thread = Thread(target=resolve_in_thread)
+            thread.start()
+            thread.join()
+            with config_resolver.using_ttl(60):
+                nested = config_resolver.resolve("lexicon:ttl")
+            inside = config_resolver.resolve("lexicon:ttl")
+
+        # Then
+        self.assertEqual(nested, 60)
+        self.assertEqual(inside, 300)
+        self.assertEqual(seen, [3600], "other threads keep the default")
+        self.assertEqual(config_resolver.resolve("lexicon:ttl"), 3600)
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_client_reused_between_populate_and_apply(self, provider_mock):
+        # Given
+        provider_mock.return_value = self.provider_mock
+        self.provider_mock.list_records.return_value = \
+            iter(self.lexicon_records_one_octo_record)
+        plan = Plan(ZONE, ZONE, [Delete(self.octo_record)], True)
+
+        # When
+        self.provider.populate(self.zone)
+        self.provider._apply(plan)
+
+        # Then
+        self.assertEqual(provider_mock.call_count, 1,
+                         "lexicon client is only created once")
+        self.provider_mock.authenticate.assert_called_once_with()
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_reauthenticate_on_rejected_credentials(self, provider_mock):
+        # Given
+        provider_mock.return_value = self.provider_mock
+        rejected = HTTPError(response=Mock(status_code=401))
+        self.provider_mock.create_record.side_effect = [rejected, True]
+        record = Record.new(ZONE, 'reauth', {
+            'ttl': 360, 'type': 'A', 'values': ['10.0.0.1']})
+        plan = Plan(ZONE, ZONE, [Create(record)], True)
+
+        # When
+        self.provider._apply(plan)
+
+        # Then
+        self.assertEqual(self.provider_mock.authenticate.call_count, 2)
+        self.assertEqual(self.provider_mock.create_record.call_count, 2)
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_provider_errors_propagate(self, provider_mock):
+        # Given
+        provider_mock.return_value = self.provider_mock
+        self.provider_mock.create_record.side_effect = \
+            HTTPError(response=Mock(status_code=500))
+        record = Record.new(ZONE, 'broken', {
+            'ttl': 360, 'type': 'A', 'values': ['10.0.0.1']})
+        plan = Plan(ZONE, ZONE, [Create(record)], True)
+
+        # Then
+        with self.assertRaises(HTTPError):
+            self.provider._apply(plan)
+        self.provider_mock.authenticate.assert_called_once_with()
+
+
+class TestLexiconClientCache(TestCase):
+
+    def test_lru_eviction(self):
+        # Given
+        cache = LexiconClientCache(max_size=2, idle_expiry=None)
+
+        # When
+        cache.put('a', Mock())
+        cache.put('b', Mock())
+        cache.get('a')
+        cache.put('c', Mock())
+
+        # Then
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'), "least recently used is evicted")
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+
+    @patch('octodns_lexicon.time.monotonic')
+    def test_idle_expiry(self, monotonic):
+        # Given
+        cache = LexiconClientCache(idle_expiry=60)
+        client = Mock(last_used=0)
+        monotonic.return_value = 0
+        cache.put('a', client)
+
+        # When
+        monotonic.return_value = 30
+        fresh = cache.get('a')
+        monotonic.return_value = 100
+        expired = cache.get('a')
+
+        # Then
+        self.assertIs(fresh, client)
+        self.assertIsNone(expired, "idle clients expire")
+        self.assertEqual(len(cache), 0)
+
+    def test_disabled(self):
+        # Given
+        cache = LexiconClientCache(max_size=0)
+
+        # When
+        cache.put('a', Mock())
+
+        # Then
+        self.assertIsNone(cache.get('a'))
+        cache.clear()
+
+
+class TestTokenBucket(TestCase):
+
+    @patch('octodns_lexicon.time.sleep')
+    @patch('octodns_lexicon.time.monotonic')
+    def test_acquire(self, monotonic, sleep):
+        # Given
+        clock = [100.0]
+        monotonic.side_effect = lambda: clock[0]
+        sleep.side_effect = lambda seconds: clock.__setitem__(
+            0, clock[0] + seconds)
+        bucket = TokenBucket(rate=2, burst=3)
+
+        # When
+        burst = [bucket.acquire() for _ in range(3)]
+        throttled = bucket.acquire()
+
+        # Then
+        self.assertEqual(burst, [0.0, 0.0, 0.0], "burst is not throttled")
+        self.assertAlmostEqual(throttled, 0.5)
+        self.assertAlmostEqual(clock[0], 100.5)
+
+    def test_shared_per_account(self):
+        # Given
+        config = dict(lexicon_config, domain='shared.example.com')
+        provider_a = LexiconProvider(id="a", lexicon_config=config,
+                                     rate_limit=5)
+        provider_b = LexiconProvider(id="b", lexicon_config=dict(config),
+                                     rate_limit=5)
+        provider_c = LexiconProvider(id="c", lexicon_config=config)
+        provider_d = LexiconProvider(id="d", lexicon_config=config,
+                                     rate_limit=10)
+        provider_e = LexiconProvider(id="e", lexicon_config=config,
+                                     rate_limit=5, rate_limit_burst=20)
+
+        # Then
+        self.assertIs(provider_a.rate_limiter, provider_b.rate_limiter)
+        self.assertEqual(provider_a.rate_limiter.capacity, 5)
+        self.assertIsNone(provider_c.rate_limiter)
+        self.assertEqual(provider_d.rate_limiter.rate, 10,
+                         "a different rate gets a bucket of its own")
+        self.assertEqual(provider_e.rate_limiter.capacity, 20)
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_every_call_is_rate_limited(self, provider_mock):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   rate_limit=1000)
+        provider_mock.return_value.list_records.return_value = \
+            iter(LEXICON_DATA)
+        provider.rate_limiter = Mock()
+
+        # When
+        provider.populate(Zone("blodapels.in.", []))
+
+        # Then
+        self.assertEqual(provider.rate_limiter.acquire.call_count, 2,
+                         "authenticate and list_records are rate limited")
+
+
+@patch('octodns_lexicon.time.sleep')
+class TestLexiconProviderRetries(TestCase):
+
+    def setUp(self):
+        self.provider = LexiconProvider(id="unittests",
+                                        lexicon_config=lexicon_config,
+                                        retries=2, retry_backoff=0.1)
+        self.record = Record.new(ZONE, 'retry', {
+            'ttl': 360, 'type': 'A', 'values': ['10.0.0.1']})
+        self.listed = [{'type': 'A', 'name': 'retry.blodapels.in',
+                        'ttl': 360, 'content': '10.0.0.1', 'id': '1'}]
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_retry_transient_error(self, provider_mock, sleep):
+        # Given
+        provider_mock = provider_mock.return_value
+        provider_mock.create_record.side_effect = [
+            HTTPError(response=Mock(status_code=503)), True]
+        provider_mock.list_records.return_value = []
+        plan = Plan(ZONE, ZONE, [Create(self.record)], True)
+
+        # When
+        self.provider._apply(plan)
+
+        # Then
+        self.assertEqual(provider_mock.create_record.call_count, 2)
+        provider_mock.list_records.assert_called_once_with(
+            'A', 'retry.blodapels.in.', '10.0.0.1')
+        self.assertEqual(sleep.call_count, 1)
+        self.assertLessEqual(sleep.call_args[0][0], 0.1)
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_no_duplicate_create(self, provider_mock, sleep):
+        # Given
+        provider_mock = provider_mock.return_value
+        provider_mock.create_record.side_effect = \
+            ConnectionError("connection reset")
+        provider_mock.list_records.return_value = self.listed
+        plan = Plan(ZONE, ZONE, [Create(self.record)], True)
+
+        # When
+        self.provider._apply(plan)
+
+        # Then
+        provider_mock.create_record.assert_called_once()
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_retries_exhausted(self, provider_mock, sleep):
+        # Given
+        provider_mock = provider_mock.return_value
+        provider_mock.delete_record.return_value = False
+        provider_mock.list_records.return_value = self.listed
+        plan = Plan(ZONE, ZONE, [Delete(self.record)], True)
+
+        # Then
+        with self.assertRaises(RecordDeleteError):
+            self.provider._apply(plan)
+        self.assertEqual(provider_mock.delete_record.call_count, 3)
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_retry_budget(self, provider_mock, sleep):
+        # Given
+        self.provider.retry_budget = 0
+        provider_mock = provider_mock.return_value
+        provider_mock.create_record.side_effect = \
+            HTTPError(response=Mock(status_code=429))
+        plan = Plan(ZONE, ZONE, [Create(self.record)], True)
+
+        # Then
+        with self.assertRaises(HTTPError):
+            self.provider._apply(plan)
+        provider_mock.create_record.assert_called_once()
+        sleep.assert_not_called()
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_no_retry_on_client_error(self, provider_mock, sleep):
+        # Given
+        provider_mock = provider_mock.return_value
+        provider_mock.create_record.side_effect = \
+            HTTPError(response=Mock(status_code=400))
+        plan = Plan(ZONE, ZONE, [Create(self.record)], True)
+
+        # Then
+        with self.assertRaises(HTTPError):
+            self.provider._apply(plan)
+        provider_mock.create_record.assert_called_once()
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_unverifiable_create_is_not_retried(self, provider_mock, sleep):
+        # Given
+        provider_mock = provider_mock.return_value
+        provider_mock.create_record.side_effect = \
+            HTTPError(response=Mock(status_code=503))
+        provider_mock.list_records.side_effect = \
+            HTTPError(response=Mock(status_code=500))
+        plan = Plan(ZONE, ZONE, [Create(self.record)], True)
+
+        # Then
+        with self.assertRaises(HTTPError):
+            self.provider._apply(plan)
+        provider_mock.create_record.assert_called_once()
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_failed_ttl_update_is_retried(self, provider_mock, sleep):
+        # Given
+        self.provider.bulk_operations = False
+        provider_mock = provider_mock.return_value
+        provider_mock.update_record.side_effect = [
+            HTTPError(response=Mock(status_code=503)),
+            HTTPError(response=Mock(status_code=503)), True]
+        untimed = dict(self.listed[0])
+        del untimed['ttl']
+        provider_mock.list_records.side_effect = [
+            [dict(self.listed[0], ttl=300)], [untimed]]
+        existing = Record.new(ZONE, 'retry', {
+            'ttl': 300, 'type': 'A', 'values': ['10.0.0.1']})
+        self.provider.remembered_ids.remember(existing, '10.0.0.1', '1')
+        plan = Plan(ZONE, ZONE, [Update(existing, self.record)], True)
+
+        # When
+        self.provider._apply(plan)
+
+        # Then
+        self.assertEqual(provider_mock.update_record.call_count, 3,
+                         "neither the old TTL nor none confirm the update")
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_escaped_content_is_verified(self, provider_mock, sleep):
+        # Given
+        provider_mock = provider_mock.return_value
+        provider_mock.create_record.side_effect = \
+            ConnectionError("connection reset")
+        provider_mock.list_records.return_value = [
+            {'type': 'TXT', 'name': 'retry.blodapels.in', 'ttl': 360,
+             'content': 'a;b', 'id': '1'}]
+        record = Record.new(ZONE, 'retry', {
+            'ttl': 360, 'type': 'TXT', 'value': 'a\\;b'})
+        plan = Plan(ZONE, ZONE, [Create(record)], True)
+
+        # When
+        self.provider._apply(plan)
+
+        # Then
+        provider_mock.create_record.assert_called_once()
+        provider_mock.list_records.assert_called_once_with(
+            'TXT', 'retry.blodapels.in.', 'a;b')
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_unverifiable_delete_is_retried(self, provider_mock, sleep):
+        # Given
+        provider_mock = provider_mock.return_value
+        provider_mock.delete_record.side_effect = [False, True]
+        provider_mock.list_records.side_effect = \
+            HTTPError(response=Mock(status_code=500))
+        plan = Plan(ZONE, ZONE, [Delete(self.record)], True)
+
+        # When
+        self.provider._apply(plan)
+
+        # Then
+        self.assertEqual(provider_mock.delete_record.call_count, 2)
+
+
+class TestLexiconProviderPrefetch(TestCase):
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_prefetch(self, provider_mock):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config)
+
+        working, broken = Mock(), Mock()
+        working.list_records.side_effect = lambda *_: iter(LEXICON_DATA)
+        broken.list_records.side_effect = \
+            HTTPError(response=Mock(status_code=500))
+        provider_mock.side_effect = lambda config: \
+            broken if config.resolve('lexicon:domain') == 'broken.in' \
+            else working
+        zone = Zone("blodapels.in.", [])
+
+        # When
+        prefetched = provider.prefetch(['blodapels.in', 'broken.in.'])
+        provider.populate(zone)
+
+        # Then
+        self.assertEqual(prefetched, ['blodapels.in.'])
+        self.assertEqual(zone.records, set(OCTODNS_DATA))
+        self.assertEqual(working.list_records.call_count, 1,
+                         "populate is served from the prefetched listing")
+
+        # And the listing is only used once
+        provider.populate(Zone("blodapels.in.", []))
+        self.assertEqual(working.list_records.call_count, 2)
+
+
+class TestLexiconRecordGroups(TestCase):
+
+    def setUp(self):
+        self.records = [
+            {'type': 'A', 'name': 'a', 'ttl': 300, 'content': '10.0.0.2',
+             'id': 1},
+            {'type': 'TXT', 'name': 'a', 'ttl': 300, 'content': 'txt',
+             'id': 2},
+            {'type': 'A', 'name': 'b', 'ttl': 60, 'content': '10.0.0.9',
+             'id': 3},
+            {'type': 'A', 'name': 'a', 'ttl': 300, 'content': '10.0.0.1',
+             'id': 4},
+            {'type': 'A', 'name': 'b', 'ttl': 60, 'content': '10.0.0.8',
+             'id': '5'}]
+
+    def _grouped(self, spill_threshold):
+        groups = LexiconRecordGroups(spill_threshold)
+        for record in self.records:
+            groups.add(record['name'], record)
+        return {key: [r['content'] for r in records]
+                for key, records in groups}
+
+    def test_in_memory_and_spilled_are_alike(self):
+        # Given
+        expected = {('a', 'A'): ['10.0.0.2', '10.0.0.1'],
+                    ('a', 'TXT'): ['txt'],
+                    ('b', 'A'): ['10.0.0.9', '10.0.0.8']}
+
+        # Then
+        self.assertEqual(self._grouped(None), expected)
+        self.assertEqual(self._grouped(2), expected,
+                         "listing order is kept across spilled runs")
+
+    def test_records_are_rebuilt(self):
+        # Given
+        groups = LexiconRecordGroups(spill_threshold=1)
+        groups.add('b', self.records[4])
+
+        # Then
+        self.assertEqual(list(groups), [(('b', 'A'), [self.records[4]])])
+
+    @patch('lexicon.providers.gandi.Provider.list_records',
+           return_value=iter(LEXICON_DATA))
+    @patch('lexicon.providers.gandi.Provider.authenticate')
+    def test_populate_spilled(self, *_):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   populate_spill_threshold=4)
+        zone = Zone("blodapels.in.", [])
+
+        # When
+        provider.populate(zone=zone)
+
+        # Then
+        self.assertEqual(zone.records, set(OCTODNS_DATA))
+
+    def test_consume_releases_listing(self):
+        # Given
+        listing = list(self.records)
+
+        # When
+        consumed = list(_consume(listing))
+
+        # Then
+        self.assertEqual(consumed, self.records)
+        self.assertEqual(listing, [])
+        self.assertEqual(list(_consume(iter(self.records))), self.records)
+
+
+class TestContentCodec(TestCase):
+
+    def test_parse_like_shlex(self):
+        for rtype, content in (
+                ('MX', '10 spool.mail.example.com.'),
+                ('MX', ' 10\tspool.mail.example.com. '),
+                ('SRV', '0 0 0   .'),
+                ('SRV', '10 1 995 mail.example.com.'),
+                ('CAA', '0 issue ";"'),
+                ('CAA', '0 issue "a b"'),
+                ('CAA', '0 issue letsencrypt.org'),
+                ('CAA', '0 iodef "mailto:\\"x\\"@example.com"'),
+                ('CAA', "0 issue 'single quoted'")):
+            codec = CONTENT_CODECS[rtype]
+            self.assertEqual(
+                codec.parse(content),
+                dict(zip(codec.fields, shlex.split(content))), content)
+
+    def test_parse_error(self):
+        with self.assertRaises(ValueError):
+            CONTENT_CODECS['MX'].parse('10')
+        with self.assertRaises(ValueError):
+            CONTENT_CODECS['SRV'].parse('0 0 "0 ."')
+
+    def test_format_all(self):
+        # Given
+        record = OCTODNS_DATA[1]
+
+        # Then
+        self.assertEqual(
+            CONTENT_CODECS['MX'].format_all(record.values),
+            ['10 spool.mail.example.com.', '50 fb.mail.example.com.'])
+
+    def test_last_token(self):
+        self.assertEqual(_last_token('10 mail.example.com'),
+                         'mail.example.com')
+        self.assertEqual(_last_token('relative '), 'relative')
+        self.assertEqual(_last_token('10 "quoted name"'), 'quoted name')
+
+
+class TestRememberedIds(TestCase):
+
+    def setUp(self):
+        self.remembered_ids = RememberedIds()
+        self.record = OCTODNS_DATA[1]
+
+    def test_unique_ids(self):
+        # When
+        self.remembered_ids.remember(self.record, 'a', 1)
+        self.remembered_ids.remember(self.record, 'b', 2)
+        unique = self.remembered_ids.has_unique_ids(self.record)
+        self.remembered_ids.remember(self.record, 'c', 1)
+
+        # Then
+        self.assertTrue(unique)
+        self.assertFalse(self.remembered_ids.has_unique_ids(self.record))
+        self.assertEqual(self.remembered_ids.get_all_ids(self.record),
+                         [1, 2, 1])
+        self.assertTrue(self.remembered_ids.has_unique_ids(OCTODNS_DATA[0]),
+                        "unknown records have no conflicting ids")
+
+    def test_keyed_by_name_and_type(self):
+        # Given
+        other_values = Record.new(ZONE, '', {
+            'ttl': 60, 'type': 'MX', 'values': [
+                {'priority': '1', 'exchange': 'mx.example.com.'}]})
+
+        # When
+        self.remembered_ids.remember(self.record, 'a', 1)
+
+        # Then
+        self.assertEqual(self.remembered_ids.get(other_values, 'a'), 1)
+
+    def test_adopt_zone_out_of_order(self):
+        # Given
+        earlier, later = RememberedIds(), RememberedIds()
+        earlier.remember(self.record, 'a', 1)
+        later.remember(self.record, 'a', 2)
+        first = self.remembered_ids.begin_zone(ZONE.name)
+        second = self.remembered_ids.begin_zone(ZONE.name)
+
+        # When
+        adopted = [
+            self.remembered_ids.adopt_zone(ZONE.name, later, second),
+            self.remembered_ids.adopt_zone(ZONE.name, earlier, first)]
+
+        # Then
+        self.assertEqual(adopted, [True, False])
+        self.assertEqual(self.remembered_ids.get_all_ids(self.record), [2])
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_populate_twice_keeps_ids_unique(self, provider_mock):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config)
+        provider_mock.return_value.list_records.side_effect = lambda *_: [
+            {'type': 'A', 'name': 'twice.blodapels.in', 'ttl': 300,
+             'content': '10.0.0.1', 'id': '1'}]
+        zone = Zone("blodapels.in.", [])
+
+        # When
+        provider.populate(Zone("blodapels.in.", []))
+        provider.populate(zone)
+
+        # Then
+        record = next(iter(zone.records))
+        self.assertEqual(provider.remembered_ids.get_all_ids(record), ['1'])
+        self.assertTrue(provider.remembered_ids.has_unique_ids(record))
+
+
+class TestSimulatedProvider(TestCase):
+
+    def setUp(self):
+        SimulatedProvider.reset()
+        self.config = OnTheFlyLexiconConfigSource('blodapels.in')
+
+    def tearDown(self):
+        SimulatedProvider.reset()
+
+    def test_crud(self):
+        # Given
+        provider = SimulatedProvider(self.config, records=[
+            {'type': 'A', 'name': 'www', 'content': '10.0.0.1'}])
+
+        # When
+        with self.config.using_ttl(300):
+            provider.create_record('A', 'www.blodapels.in.', '10.0.0.2')
+            provider.create_record('A', 'www.blodapels.in.', '10.0.0.2')
+        listed = provider.list_records('A', 'www')
+        provider.update_record(listed[0]['id'], 'A', 'www', '10.0.0.3')
+        provider.delete_record(None, 'A', 'www', '10.0.0.2')
+
+        # Then
+        self.assertEqual(
+            [(r['content'], r['ttl'], r['id'])
+             for r in provider.list_records()],
+            [('10.0.0.3', 3600, '1')])
+        self.assertEqual(listed[1]['ttl'], 300)
+        self.assertEqual(provider.calls['create_record'], 2)
+        self.assertFalse(provider.update_record('404', 'A', 'www', 'x'))
+
+    def test_shared_store(self):
+        # Given
+        SimulatedProvider(self.config).create_record('A', '@', '10.0.0.1')
+
+        # When
+        listed = SimulatedProvider(self.config).list_records()
+        other = SimulatedProvider(self.config, store='other').list_records()
+
+        # Then
+        self.assertEqual(listed, [{'type': 'A', 'name': 'blodapels.in',
+                                   'ttl': 3600, 'content': '10.0.0.1',
+                                   'id': '1'}])
+        self.assertEqual(other, [])
+        SimulatedProvider.reset('other')
+        self.assertNotIn('other', SimulatedProvider._stores)
+
+    def test_quirks(self):
+        # Given
+        provider = SimulatedProvider(
+            self.config, unique_ids=False, ttl_updates=False, records=[
+                {'type': 'A', 'name': 'www', 'content': '10.0.0.1'},
+                {'type': 'A', 'name': 'www', 'content': '10.0.0.2'},
+                {'type': 'TXT', 'name': '@', 'content': 'txt'}])
+
+        # When
+        ids = [r['id'] for r in provider.list_records()]
+        with self.config.using_ttl(60):
+            provider.update_record(None, 'A', 'www', '10.0.0.3')
+        updated = provider.list_records('A')
+        provider.delete_record('www', 'A', 'www', '10.0.0.3')
+
+        # Then
+        self.assertEqual(ids, ['www', 'www', '@'])
+        self.assertEqual([(r['content'], r['ttl']) for r in updated],
+                         [('10.0.0.3', 3600), ('10.0.0.2', 3600)])
+        self.assertEqual([r['type'] for r in provider.list_records()],
+                         ['TXT'], "delete by id removes the whole name")
+
+    @patch('octodns_lexicon.time.sleep')
+    def test_failures(self, sleep):
+        # Given
+        failing = SimulatedProvider(self.config, error_rate=1, latency=0.3,
+                                    seed=1)
+        lossy = SimulatedProvider(self.config, lost_response_rate=1,
+                                  store='lossy')
+        limited = SimulatedProvider(self.config, rate_limit=2,
+                                    store='limited')
+
+        # Then
+        with self.assertRaises(HTTPError) as ctx:
+            failing.authenticate()
+        self.assertEqual(ctx.exception.response.status_code, 500)
+        sleep.assert_called_once()
+
+        for action, args in (('create_record', ('A', 'www', '10.0.0.1')),
+                             ('update_record', ('1', 'A', 'www', '10.0.0.2')),
+                             ('delete_record', ('1',))):
+            with self.assertRaises(HTTPError) as ctx:
+                getattr(lossy, action)(*args)
+            self.assertEqual(ctx.exception.response.status_code, 502)
+        self.assertEqual(lossy.calls['delete_record'], 1)
+        self.assertEqual(lossy.list_records(), [], "mutations went through")
+
+        with patch('octodns_lexicon.time.monotonic', return_value=10):
+            limited.authenticate()
+            limited.list_records()
+            with self.assertRaises(HTTPError) as ctx:
+                limited.list_records()
+        self.assertEqual(ctx.exception.response.status_code, 429)
+        with patch('octodns_lexicon.time.monotonic', return_value=11):
+            self.assertEqual(limited.list_records(), [],
+                             "calls are allowed again a second later")
+
+    def test_rate_limit_across_zones(self):
+        # Given
+        providers = [SimulatedProvider(OnTheFlyLexiconConfigSource(domain),
+                                       rate_limit=2)
+                     for domain in ('blodapels.in', 'other.in')]
+        other_store = SimulatedProvider(self.config, rate_limit=2,
+                                        store='other')
+
+        # When
+        with patch('octodns_lexicon.time.monotonic', return_value=10):
+            for provider in providers:
+                provider.authenticate()
+            with self.assertRaises(HTTPError) as ctx:
+                providers[1].list_records()
+            other_store.authenticate()
+
+        # Then
+        self.assertEqual(ctx.exception.response.status_code, 429,
+                         "both zones count against the one limit")
+        self.assertEqual(other_store.calls['authenticate'], 1)
+
+    @patch('octodns_lexicon.time.sleep')
+    def test_round_trip(self, _):
+        # Given
+        provider = LexiconProvider(
+            id="unittests", lexicon_config=lexicon_config, retries=3,
+            max_workers=4, simulate={'lost_response_rate': 0.3, 'seed': 7})
+        plan = Plan(ZONE, ZONE, [Create(r) for r in OCTODNS_DATA], True)
+
+        # When
+        provider._apply(plan)
+        zone = Zone("blodapels.in.", [])
+        provider.populate(zone)
+
+        # Then
+        self.assertEqual(zone.records, set(OCTODNS_DATA))
+
+
+def record_metric(event):
+    record_metric.events.append(event)
+
+
+record_metric.events = []
+
+
+class TestAdaptiveConcurrency(TestCase):
+
+    @staticmethod
+    def _error(status_code):
+        return HTTPError(response=Mock(status_code=status_code))
+
+    def test_additive_increase(self):
+        # Given
+        concurrency = AdaptiveConcurrency(8, initial=2)
+        tickets = [concurrency.acquire(), concurrency.acquire()]
+
+        # When
+        for _ in range(3):
+            concurrency.release(tickets.pop(0), 'list_records', 0.1)
+            tickets.append(concurrency.acquire())
+        for ticket in tickets:
+            concurrency.release(ticket, 'list_records', 0.1)
+
+        # Then
+        state = concurrency.state()
+        self.assertEqual(state['limit'], 3)
+        self.assertEqual(state['increases'], 1)
+        self.assertEqual(state['in_flight'], 0)
+        self.assertAlmostEqual(state['fastest']['list_records'], 0.1)
+
+    def test_no_increase_unless_saturated(self):
+        # Given
+        concurrency = AdaptiveConcurrency(8, initial=2)
+
+        # When
+        for _ in range(10):
+            concurrency.release(concurrency.acquire(), 'list_records', 0.1)
+
+        # Then
+        self.assertEqual(concurrency.state()['limit'], 2)
+
+    def test_no_increase_when_slow(self):
+        # Given
+        concurrency = AdaptiveConcurrency(8, initial=1)
+        concurrency.release(concurrency.acquire(), 'create_record', 0.1)
+        limit = concurrency.limit
+
+        # When
+        concurrency.release(concurrency.acquire(), 'create_record', 0.5)
+
+        # Then
+        self.assertEqual(concurrency.limit, limit)
+        self.assertAlmostEqual(concurrency.fastest['create_record'], 0.101)
+
+    def test_max_limit(self):
+        # Given
+        concurrency = AdaptiveConcurrency(2, initial=4)
+
+        # When
+        for _ in range(10):
+            tickets = [concurrency.acquire(), concurrency.acquire()]
+            for ticket in tickets:
+                concurrency.release(ticket, 'list_records', 0.1)
+
+        # Then
+        self.assertEqual(concurrency.state()['limit'], 2)
+
+    def test_multiplicative_decrease(self):
+        # Given
+        concurrency = AdaptiveConcurrency(16, initial=8)
+        tickets = [concurrency.acquire() for _ in range(3)]
+
+        # When
+        concurrency.release(tickets[0], 'create_record', 0.1,
+                            self._error(429))
+        concurrency.release(tickets[1], 'create_record', 0.1,
+                            self._error(503))
+        after_round = concurrency.state()['limit']
+        concurrency.release(tickets[2], 'create_record', 0.1,
+                            self._error(404))
+        concurrency.release(concurrency.acquire(), 'create_record', 0.1,
+                            ConnectionError())
+        concurrency.release(concurrency.acquire(), 'create_record', 0.1,
+                            self._error(500))
+        concurrency.release(concurrency.acquire(), 'create_record', 0.1,
+                            self._error(500))
+
+        # Then
+        self.assertEqual(after_round, 4, "cut once per round")
+        state = concurrency.state()
+        self.assertEqual(state['limit'], 1, "and never below min_limit")
+        self.assertEqual(state['decreases'], 3)
+        self.assertEqual(state['fastest'], {})
+
+    def test_acquire_waits(self):
+        # Given
+        concurrency = AdaptiveConcurrency(4, initial=1)
+        ticket = concurrency.acquire()
+        acquired = []
+        waiting = Thread(target=lambda: acquired.append(
+            concurrency.acquire()))
+
+        # When
+        waiting.start()
+        waiting.join(0.1)
+        queued = list(acquired)
+        concurrency.release(ticket, 'list_records', 0.1)
+        waiting.join()
+
+        # Then
+        self.assertEqual(queued, [])
+        self.assertEqual(acquired, [0])
+        self.assertEqual(concurrency.state()['in_flight'], 1)
+
+    def test_provider(self):
+        # Given
+        self.addCleanup(SimulatedProvider.reset)
+        config = dict(lexicon_config, domain='adaptive.example.com')
+        provider = LexiconProvider(id="a", lexicon_config=config,
+                                   max_workers=2, adaptive_concurrency=8,
+                                   simulate={})
+        other = LexiconProvider(id="b", lexicon_config=dict(config))
+        shared = LexiconProvider(id="c", lexicon_config=dict(config),
+                                 adaptive_concurrency=8)
+        larger = LexiconProvider(id="d", lexicon_config=dict(config),
+                                 adaptive_concurrency=16)
+        tolerant = LexiconProvider(id="e", lexicon_config=dict(config),
+                                   adaptive_concurrency=8,
+                                   adaptive_latency_tolerance=4)
+        provider.populate(Zone("adaptive.example.com.", []))
+        provider._client_for('adaptive.example.com').provider.error_rate = 1
+
+        # When
+        with self.assertRaises(HTTPError):
+            provider.populate(Zone("adaptive.example.com.", []))
+
+        # Then
+        self.assertIsNone(other.concurrency)
+        self.assertIs(shared.concurrency, provider.concurrency)
+        self.assertEqual(larger.concurrency.max_limit, 16)
+        self.assertEqual(tolerant.concurrency.latency_tolerance, 4)
+        self.assertEqual((provider.max_workers,
+                          provider.populate_max_workers), (8, 8))
+        state = provider.concurrency.state()
+        self.assertEqual((state['limit'], state['in_flight'],
+                          state['decreases']), (1, 0, 1))
+        self.assertIn('list_records', state['fastest'])
+
+
+class TestProviderMetrics(TestCase):
+
+    def test_observe(self):
+        # Given
+        events = []
+        metrics = ProviderMetrics('unittests', callback=events.append)
+
+        # When
+        metrics.observe('create_record', 'blodapels.in', 'A', 0.02)
+        metrics.observe('create_record', 'blodapels.in', 'A', 0.2,
+                        HTTPError(response=Mock(status_code=503)))
+        metrics.observe('delete_record', 'blodapels.in', 'A', 60, False)
+        metrics.observe('list_records', 'blodapels.in', None, 0.5,
+                        ConnectionError())
+        metrics.retry('create_record', 'blodapels.in', 'A')
+        text = metrics.prometheus_text()
+
+        # Then
+        key = ('create_record', 'blodapels.in', 'A')
+        self.assertEqual(metrics.calls[key], 2)
+        self.assertAlmostEqual(metrics.seconds[key], 0.22)
+        self.assertEqual(metrics.errors[key + ('503',)], 1)
+        self.assertEqual(events[1]['error'], '503')
+        self.assertEqual(events[2]['error'], 'false')
+        self.assertIn('octodns_lexicon_calls_total{provider="unittests",'
+                      'action="create_record",zone="blodapels.in",'
+                      'rtype="A"} 2', text)
+        self.assertIn('octodns_lexicon_call_errors_total{provider='
+                      '"unittests",action="list_records",zone='
+                      '"blodapels.in",rtype="",error="ConnectionError"} 1',
+                      text)
+        self.assertIn('octodns_lexicon_call_retries_total{provider='
+                      '"unittests",action="create_record",zone='
+                      '"blodapels.in",rtype="A"} 1', text)
+        self.assertIn('octodns_lexicon_call_duration_seconds_bucket{provider='
+                      '"unittests",action="create_record",zone='
+                      '"blodapels.in",rtype="A",le="0.025"} 1', text)
+        self.assertIn('octodns_lexicon_call_duration_seconds_bucket{provider='
+                      '"unittests",action="delete_record",zone='
+                      '"blodapels.in",rtype="A",le="30.0"} 0', text)
+        self.assertIn('octodns_lexicon_call_duration_seconds_bucket{provider='
+                      '"unittests",action="delete_record",zone='
+                      '"blodapels.in",rtype="A",le="+Inf"} 1', text)
+
+    def test_label_escaping(self):
+        # Given
+        metrics = ProviderMetrics('a "quoted"\\id\n')
+
+        # When
+        metrics.observe('authenticate', 'blodapels.in', None, 0.1)
+
+        # Then
+        self.assertIn('provider="a \\"quoted\\"\\\\id\\n"',
+                      metrics.prometheus_text())
+
+    @patch('octodns_lexicon.time.sleep')
+    def test_provider_calls_are_measured(self, _):
+        # Given
+        record_metric.events.clear()
+        self.addCleanup(SimulatedProvider.reset)
+        with TemporaryDirectory() as tmp:
+            textfile = join(tmp, 'lexicon.prom')
+            provider = LexiconProvider(
+                id="unittests", lexicon_config=lexicon_config, retries=1,
+                metrics_textfile=textfile,
+                metrics_callback='octodns_lexicon_test:record_metric',
+                simulate={'lost_response_rate': 1})
+            plan = Plan(ZONE, ZONE, [Create(OCTODNS_DATA[0])], True)
+
+            # When
+            provider._apply(plan)
+            with open(textfile) as fh:
+                text = fh.read()
+
+        # Then
+        self.assertEqual([(e['action'], e['rtype'], e['error'])
+                          for e in record_metric.events],
+                         [('authenticate', None, None),
+                          ('create_record', 'A', '502'),
+                          ('list_records', 'A', None)])
+        self.assertIn('octodns_lexicon_call_retries_total{provider='
+                      '"unittests",action="create_record",zone='
+                      '"blodapels.in",rtype="A"} 1', text)
+
+    def test_failing_callback(self):
+        # Given
+        self.addCleanup(SimulatedProvider.reset)
+        provider = LexiconProvider(
+            id="unittests", lexicon_config=lexicon_config, simulate={},
+            metrics_callback=Mock(side_effect=ValueError('exporter down')))
+        plan = Plan(ZONE, ZONE, [Create(OCTODNS_DATA[0])], True)
+
+        # When
+        with self.assertLogs('ProviderMetrics[unittests]', 'WARNING') as logs:
+            provider._apply(plan)
+
+        # Then
+        self.assertEqual(len(provider._client_for('blodapels.in')
+                             .provider.list_records()), 1)
+        self.assertIn('exporter down', logs.output[0])
+        self.assertEqual(provider.metrics.calls[
+            ('create_record', 'blodapels.in', 'A')], 1)
+
+
+class RecordedSpan:
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        record_span.spans.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.error = exc_type
+        return False
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+
+def record_span(name, attributes):
+    return RecordedSpan(name, attributes)
+
+
+record_span.spans = []
+
+
+class TestTracing(TestCase):
+
+    def setUp(self):
+        SimulatedProvider.reset()
+        self.tmpdir = TemporaryDirectory()
+        self.trace_file = join(self.tmpdir.name, 'trace.json')
+
+    def tearDown(self):
+        SimulatedProvider.reset()
+        self.tmpdir.cleanup()
+
+    def _provider(self, simulate=None, **kwargs):
+        return LexiconProvider(id="unittests", lexicon_config=lexicon_config,
+                               simulate=simulate or {
+                                   'records': [{'type': 'A', 'name': 'www',
+                                                'content': '10.0.0.1'}]},
+                               **kwargs)
+
+    def _events(self):
+        with open(self.trace_file) as fh:
+            trace = json.load(fh)
+        return trace['traceEvents']
+
+    def test_disabled(self):
+        # Given
+        provider = self._provider()
+
+        # When
+        provider.populate(Zone("blodapels.in.", []))
+
+        # Then
+        self.assertIsNone(provider.tracer)
+        self.assertIs(provider._span('populate'), octodns_lexicon._NO_SPAN)
+
+    def test_trace_file(self):
+        # Given
+        provider = self._provider(trace_file=self.trace_file)
+        existing = Zone("blodapels.in.", [])
+
+        # When
+        provider.populate(existing)
+        provider._apply(Plan(existing, ZONE, [Create(OCTODNS_DATA[0])],
+                             True))
+
+        # Then
+        events = self._events()
+        self.assertEqual(
+            [e['name'] for e in events],
+            ['lexicon.authenticate', 'lexicon.list_records',
+             'populate.list_records', 'populate.group', 'populate.data_for',
+             'populate.record_new', 'populate.add_record', 'populate',
+             'apply.rrsets', 'lexicon.create_record', 'apply.operations',
+             'apply'])
+        self.assertTrue(all(e['ph'] == 'X' and e['dur'] >= 0 and
+                            e['args']['provider'] == 'unittests'
+                            for e in events))
+        by_name = {e['name']: e for e in events}
+        self.assertEqual(by_name['populate']['args'],
+                         {'provider': 'unittests', 'zone': 'blodapels.in.',
+                          'records': 1, 'exists': True})
+        self.assertEqual(by_name['populate.list_records']['args']['records'],
+                         1)
+        self.assertEqual(by_name['apply.rrsets']['args']['operations'], 1)
+        self.assertEqual(by_name['lexicon.create_record']['args']['rtype'],
+                         'A')
+        populate = by_name['populate']
+        self.assertTrue(all(
+            populate['ts'] <= e['ts'] and
+            e['ts'] + e['dur'] <= populate['ts'] + populate['dur']
+            for e in events if e['name'].startswith('populate.')))
+
+    def test_incremental_flush(self):
+        # Given
+        provider = self._provider(trace_file=self.trace_file)
+        provider.tracer.flush()
+        with open(self.trace_file) as fh:
+            empty = json.load(fh)
+
+        # When
+        provider.populate(Zone("blodapels.in.", []))
+        with open(self.trace_file, 'rb') as fh:
+            first = fh.read()
+        provider.populate(Zone("blodapels.in.", []))
+        with open(self.trace_file, 'rb') as fh:
+            second = fh.read()
+
+        # Then
+        self.assertEqual(empty, {'traceEvents': [], 'displayTimeUnit': 'ms'})
+        self.assertEqual(provider.tracer.events, [],
+                         "flushed spans are not kept")
+        self.assertTrue(second.startswith(
+            first[:-len(provider.tracer.TAIL)]),
+            "the spans flushed before are not written again")
+        names = [e['name'] for e in self._events()]
+        self.assertEqual(names.count('populate'), 2)
+
+    @patch('octodns_lexicon.time.sleep')
+    def test_errors(self, _):
+        # Given
+        provider = self._provider(retries=1, trace_file=self.trace_file)
+        provider._client_for('blodapels.in').provider.error_rate = 1
+
+        # When
+        with self.assertRaises(HTTPError):
+            provider._apply(Plan(ZONE, ZONE, [Create(OCTODNS_DATA[0])],
+                                 True))
+
+        # Then
+        events = self._events()
+        self.assertEqual([(e['name'], e['args'].get('error'))
+                          for e in events],
+                         [('lexicon.authenticate', None),
+                          ('apply.rrsets', None),
+                          ('lexicon.create_record', 'HTTPError'),
+                          ('lexicon.list_records', 'HTTPError'),
+                          ('apply.retry', 'HTTPError'),
+                          ('apply.operations', 'HTTPError'),
+                          ('apply.error', 'HTTPError'),
+                          ('apply', 'HTTPError')])
+        retry = events[4]['args']
+        self.assertEqual((retry['action'], retry['attempt']),
+                         ('create_record', 1))
+
+    def test_falsy_return(self):
+        # Given
+        provider = self._provider(trace_file=self.trace_file)
+        client = Mock(zone='blodapels.in')
+        client.call.return_value = False
+
+        # When
+        provider._call(client, 'delete_record', None, 'A')
+        provider.tracer.flush()
+
+        # Then
+        self.assertEqual(self._events()[0]['args']['error'], 'false')
+
+    def test_hook(self):
+        # Given
+        record_span.spans.clear()
+        provider = self._provider(
+            trace_hook='octodns_lexicon_test:record_span')
+
+        # When
+        provider.populate(Zone("blodapels.in.", []))
+
+        # Then
+        self.assertEqual([s.name for s in record_span.spans],
+                         ['populate', 'populate.list_records',
+                          'lexicon.authenticate', 'lexicon.list_records',
+                          'populate.group', 'populate.data_for',
+                          'populate.record_new', 'populate.add_record'])
+        self.assertEqual(record_span.spans[0].attributes,
+                         {'provider': 'unittests', 'zone': 'blodapels.in.',
+                          'records': 1, 'exists': True},
+                         "attributes set later go through set_attribute")
+        self.assertFalse(exists(self.trace_file))
+
+
+class TestOperationsForChange(TestCase):
+
+    def setUp(self):
+        self.provider = LexiconProvider(id="unittests",
+                                        lexicon_config=lexicon_config)
+        self.existing = Record.new(ZONE, 'ops', {
+            'ttl': 300, 'type': 'A', 'values': ['10.0.0.1', '10.0.0.2']})
+        self.name = 'ops.blodapels.in.'
+
+    def _remember(self, *ids):
+        for content, _id in zip(self.existing.values, ids):
+            self.provider.remembered_ids.remember(self.existing, content,
+                                                  _id)
+
+    def _operations(self, new):
+        return [(o.action, o.record.content, o.record.ttl, o.identifier)
+                for o in self.provider._operations_for_change(
+                    Update(self.existing, new))]
+
+    def test_ttl_only_change_with_unique_ids(self):
+        # Given
+        self._remember('1', '2')
+        new = Record.new(ZONE, 'ops', {
+            'ttl': 60, 'type': 'A', 'values': ['10.0.0.1', '10.0.0.2']})
+
+        # Then
+        self.assertEqual(self._operations(new), [
+            ('update_record', '10.0.0.1', 60, '1'),
+            ('update_record', '10.0.0.2', 60, '2')])
+
+    def test_ttl_only_change_without_unique_ids(self):
+        # Given
+        self._remember('ops', 'ops')
+        new = Record.new(ZONE, 'ops', {
+            'ttl': 60, 'type': 'A', 'values': ['10.0.0.1']})
+
+        # Then
+        self.assertEqual(self._operations(new), [
+            ('delete_record', '10.0.0.1', 300, None),
+            ('create_record', '10.0.0.1', 60, None),
+            ('delete_record', '10.0.0.2', 300, None)],
+            "same value is deleted before being created again, and shared "
+            "ids are never used")
+
+    def test_values_paired_by_content_first(self):
+        # Given
+        self._remember('1', '2')
+        new = Record.new(ZONE, 'ops', {
+            'ttl': 60, 'type': 'A', 'values': ['10.0.0.0', '10.0.0.2']})
+
+        # Then
+        self.assertEqual(self._operations(new), [
+            ('update_record', '10.0.0.2', 60, '2'),
+            ('update_record', '10.0.0.0', 60, '1')])
+
+    def test_no_operations(self):
+        self.assertEqual(self._operations(self.existing), [])
+
+    def test_cheapest_candidate(self):
+        # Given
+        self._remember('1', '2')
+        new = Record.new(ZONE, 'ops', {
+            'ttl': 300, 'type': 'A', 'values': ['10.0.0.3']})
+
+        # When
+        with patch.object(LexiconProvider, '_cost',
+                          side_effect=lambda ops: -len(ops)):
+            operations = self._operations(new)
+
+        # Then
+        self.assertEqual(operations, [
+            ('delete_record', '10.0.0.1', 300, '1'),
+            ('delete_record', '10.0.0.2', 300, '2'),
+            ('create_record', '10.0.0.3', 300, None)],
+            "the rrset is replaced when that is cheaper")
+
+
+class TestBulkAdapters(TestCase):
+
+    def setUp(self):
+        self.record = Record.new(ZONE, 'bulk', {
+            'ttl': 60, 'type': 'A', 'values': ['10.0.0.1', '10.0.0.2']})
+        self.url = '/domains/blodapels.in/records/bulk/A'
+
+    @patch('lexicon.providers.gandi.Provider._request')
+    def test_gandi_replace_rrset(self, request):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config)
+        plan = Plan(ZONE, ZONE, [Create(self.record)], True)
+
+        # When
+        provider._apply(plan)
+        provider._apply(Plan(ZONE, ZONE, [Delete(self.record)], True))
+
+        # Then
+        self.assertEqual(request.call_args_list, [
+            call('GET', '/domains/blodapels.in', query_params=None),
+            call('PUT', self.url, data={'rrset_values': ['10.0.0.1',
+                                                         '10.0.0.2'],
+                                        'rrset_ttl': 300},
+                 query_params=None),
+            call('DELETE', self.url, query_params=None)])
+
+    @patch('lexicon.providers.gandi.Provider._request')
+    def test_bulk_operations_disabled(self, request):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   bulk_operations=False)
+
+        # When
+        client = provider._client_for('blodapels.in')
+
+        # Then
+        self.assertIsNone(client.adapter)
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_unsupported(self, provider_mock):
+        # Given
+        provider_mock.return_value.protocol = 'rpc'
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config)
+
+        # When
+        client = provider._client_for('blodapels.in')
+
+        # Then
+        self.assertIsNone(client.adapter)
+
+    def test_abstract(self):
+        # Given
+        class Incomplete(BulkAdapter):
+            pass
+
+        class Complete(BulkAdapter):
+
+            def replace_rrset(self, provider, rtype, name, content, ttl):
+                return True
+
+        # Then
+        with self.assertRaises(TypeError):
+            Incomplete()
+        self.assertTrue(Complete().supports(None))
+
+    @patch('octodns_lexicon.time.sleep')
+    def test_register_and_retry(self, _):
+        # Given
+        replaced = []
+
+        @register_bulk_adapter('unittest-bulk')
+        class Adapter(BulkAdapter):
+
+            def replace_rrset(self, provider, rtype, name, content, ttl):
+                replaced.append((rtype, name, content, ttl))
+                if len(replaced) == 1:
+                    raise HTTPError(response=Mock(status_code=503))
+                return True
+
+        self.addCleanup(BULK_ADAPTERS.pop, 'unittest-bulk')
+        self.addCleanup(SimulatedProvider.reset)
+        provider = LexiconProvider(
+            id="unittests", retries=1, simulate={},
+            lexicon_config={'provider_name': 'unittest-bulk'})
+        plan = Plan(ZONE, ZONE, [Create(self.record)], True)
+
+        # When
+        provider._apply(plan)
+
+        # Then
+        self.assertEqual(replaced, 2 * [
+            ('A', 'bulk.blodapels.in.', ('10.0.0.1', '10.0.0.2'), 60)])
+        self.assertIsInstance(BULK_ADAPTERS['unittest-bulk'], Adapter)
+
+
+class TestApiCallBudget(TestCase):
+
+    def setUp(self):
+        self.existing = Record.new(ZONE, 'budget', {
+            'ttl': 300, 'type': 'A', 'values': ['10.0.0.1', '10.0.0.2']})
+        self.new = Record.new(ZONE, 'budget', {
+            'ttl': 300, 'type': 'A', 'values': ['10.0.0.3', '10.0.0.4',
+                                                '10.0.0.5']})
+        self.plan = Plan(ZONE, ZONE, [Update(self.existing, self.new),
+                                      Create(OCTODNS_DATA[1]),
+                                      Delete(OCTODNS_DATA[3])], True)
+
+    def _provider(self, **kwargs):
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config, **kwargs)
+        for content, _id in (('10.0.0.1', 'budget'), ('10.0.0.2', 'budget')):
+            provider.remembered_ids.remember(self.existing, content, _id)
+        return provider
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_estimate(self, provider_mock):
+        # When
+        estimate = self._provider().estimate_api_calls(self.plan)
+
+        # Then
+        self.assertEqual(estimate, {
+            'zone': 'blodapels.in.',
+            'total': 8,
+            'by_action': {'create_record': 5, 'delete_record': 3},
+            'by_rtype': {'A': 5, 'CNAME': 1, 'MX': 2}})
+        provider_mock.return_value.create_record.assert_not_called()
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_estimate_matches_apply(self, provider_mock):
+        # Given
+        provider = self._provider(max_api_calls=8)
+        provider_mock = provider_mock.return_value
+
+        # When
+        provider._apply(self.plan)
+
+        # Then
+        self.assertEqual(provider_mock.create_record.call_count, 5)
+        self.assertEqual(provider_mock.delete_record.call_count, 3)
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_budget_exceeded(self, provider_mock):
+        # Given
+        provider = self._provider(max_api_calls=7)
+
+        # Then
+        with self.assertRaises(ApiCallBudgetExceeded) as ctx:
+            provider._apply(self.plan)
+        self.assertEqual(ctx.exception.estimate['total'], 8)
+        provider_mock.return_value.create_record.assert_not_called()
+        provider_mock.return_value.delete_record.assert_not_called()
+
+
+def a_records(*names):
+    return {name: {'ttl': 3600, 'type': 'A', 'value': '10.0.0.1'}
+            for name in names}
+
+
+class SimulatedZoneTestCase(TestCase):
+    """Plans and applies blodapels.in. against a simulated provider seeded
+    with `records`, each provider built with `options`."""
+
+    records = []
+    desired = {}
+
+    def setUp(self):
+        SimulatedProvider.reset()
+        self.addCleanup(SimulatedProvider.reset)
+        self.tmpdir = TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def options(self):
+        return {}
+
+    def _provider(self, simulate=None, **kwargs):
+        return LexiconProvider(id="unittests", lexicon_config=lexicon_config,
+                               simulate=dict({'records': self.records},
+                                             **(simulate or {})),
+                               **dict(self.options(), **kwargs))
+
+    def _plan(self, provider, desired=None):
+        existing = Zone("blodapels.in.", [])
+        provider.populate(existing)
+        zone = Zone("blodapels.in.", [])
+        for name, data in (self.desired if desired is None
+                           else desired).items():
+            zone.add_record(Record.new(zone, name, data))
+        return Plan(existing, zone, existing.changes(zone, provider), True)
+
+    @staticmethod
+    def _record(zone, name):
+        return next(r for r in zone.records if r.name == name)
+
+    @staticmethod
+    def _list_calls(provider, rtype=''):
+        return provider.metrics.calls[('list_records', 'blodapels.in',
+                                       rtype)]
+
+
+class TestZoneSnapshots(SimulatedZoneTestCase):
+
+    records = [
+        {'type': 'A', 'name': 'www', 'content': '10.0.0.1'},
+        {'type': 'A', 'name': 'www', 'content': '10.0.0.2'},
+        {'type': 'TXT', 'name': '@', 'content': 'a;b'}]
+
+    def setUp(self):
+        super().setUp()
+        self.path = join(self.tmpdir.name, 'snapshots.db')
+
+    def options(self):
+        return {'snapshot_cache': self.path}
+
+    def test_populate_from_snapshot(self):
+        # Given
+        first, second = self._provider(), self._provider()
+        zone, again = Zone("blodapels.in.", []), Zone("blodapels.in.", [])
+
+        # When
+        first.populate(zone)
+        second.populate(again)
+
+        # Then
+        self.assertEqual(self._list_calls(first), 1)
+        self.assertEqual(self._list_calls(second), 0)
+        self.assertEqual(again.records, zone.records)
+        self.assertEqual(
+            {r._type: r.values for r in again.records},
+            {'A': ['10.0.0.1', '10.0.0.2'], 'TXT': ['a\\;b']})
+
+    def test_stale_snapshot(self):
+        # Given
+        self._provider().populate(Zone("blodapels.in.", []))
+        provider = self._provider(snapshot_ttl=0)
+
+        # When
+        provider.populate(Zone("blodapels.in.", []))
+
+        # Then
+        self.assertEqual(self._list_calls(provider), 1)
+
+    def test_write_through(self):
+        # Given
+        provider = self._provider()
+        plan = self._plan(provider, {
+            'www': {'ttl': 300, 'type': 'A',
+                    'values': ['10.0.0.1', '10.0.0.3']},
+            'mail': {'ttl': 300, 'type': 'A', 'value': '10.0.0.9'},
+            '': {'ttl': 3600, 'type': 'TXT', 'value': 'a\\;b'}})
+        www, mail = (self._record(plan.desired, n) for n in ('www', 'mail'))
+
+        # When
+        provider._apply(plan)
+        later = self._provider()
+        populated = Zone("blodapels.in.", [])
+        later.populate(populated)
+
+        # Then
+        self.assertEqual(self._list_calls(later), 0)
+        self.assertEqual(populated.records, plan.desired.records)
+        self.assertEqual(later.remembered_ids.get(www, '10.0.0.3'), '2',
+                         "the updated value keeps its id")
+        self.assertIsNone(later.remembered_ids.get(mail, '10.0.0.9'))
+
+        # And listing the zone finds the same
+        fresh = self._provider(snapshot_ttl=0)
+        relisted = Zone("blodapels.in.", [])
+        fresh.populate(relisted)
+        self.assertEqual(relisted.records, plan.desired.records)
+
+    def test_failed_apply_invalidates(self):
+        # Given
+        provider = self._provider()
+        plan = self._plan(provider, {
+            'mail': {'ttl': 300, 'type': 'A', 'value': '10.0.0.9'}})
+        provider._client_for('blodapels.in').provider.error_rate = 1
+
+        # When
+        with self.assertRaises(HTTPError):
+            provider._apply(plan)
+
+        # Then
+        self.assertIsNone(ZoneSnapshotCache(self.path).get(
+            provider._account, 'blodapels.in.'))
+
+    def test_write_through_without_snapshot(self):
+        # Given
+        provider = self._provider()
+        plan = self._plan(provider)
+        provider.snapshots.invalidate(provider._account, 'blodapels.in.')
+
+        # When
+        provider._apply(plan)
+
+        # Then
+        self.assertIsNone(provider.snapshots.get(provider._account,
+                                                 'blodapels.in.'))
+        provider.snapshots.close()
+
+
+class TestZoneState(SimulatedZoneTestCase):
+
+    records = [
+        {'type': 'A', 'name': 'www', 'content': '10.0.0.1'},
+        {'type': 'A', 'name': 'www', 'content': '10.0.0.2'},
+        {'type': 'CNAME', 'name': 'old', 'content': 'www.blodapels.in.'}]
+    desired = {
+        'www': {'ttl': 300, 'type': 'A', 'values': ['10.0.0.1', '10.0.0.3']},
+        'mail': {'ttl': 300, 'type': 'A', 'value': '10.0.0.9'}}
+
+    def options(self):
+        return {'zone_state_ttl': 300}
+
+    def test_repeat_populate(self):
+        # Given
+        provider = self._provider()
+        zone, again = Zone("blodapels.in.", []), Zone("blodapels.in.", [])
+
+        # When
+        provider.populate(zone)
+        provider.populate(again)
+
+        # Then
+        self.assertEqual(self._list_calls(provider), 1)
+        self.assertEqual(again.records, zone.records)
+        self.assertEqual(
+            {r._type: r.values if r._type == 'A' else r.value
+             for r in again.records},
+            {'A': ['10.0.0.1', '10.0.0.2'], 'CNAME': 'www.blodapels.in.'})
+
+    def test_stale_state(self):
+        # Given
+        provider = self._provider()
+        provider.populate(Zone("blodapels.in.", []))
+        provider.zone_states.ttl = 0
+
+        # When
+        provider.populate(Zone("blodapels.in.", []))
+
+        # Then
+        self.assertEqual(self._list_calls(provider), 2)
+
+    def test_write_through(self):
+        # Given
+        provider = self._provider()
+        plan = self._plan(provider)
+        www, mail = (self._record(plan.desired, n) for n in ('www', 'mail'))
+
+        # When
+        provider._apply(plan)
+        populated = Zone("blodapels.in.", [])
+        provider.populate(populated)
+
+        # Then
+        self.assertEqual(self._list_calls(provider), 1)
+        self.assertEqual(self._list_calls(provider, 'A'), 1,
+                         "only the rrset created in is listed")
+        self.assertEqual(populated.records, plan.desired.records)
+        self.assertEqual(provider.remembered_ids.get(www, '10.0.0.3'), '2',
+                         "the updated value keeps its id")
+
+        # And the ids are the ones the provider has
+        fresh = LexiconProvider(id="unittests",
+                                lexicon_config=lexicon_config, simulate={})
+        relisted = Zone("blodapels.in.", [])
+        fresh.populate(relisted)
+        self.assertEqual(relisted.records, plan.desired.records)
+        self.assertIsNotNone(provider.remembered_ids.get(mail, '10.0.0.9'))
+        self.assertEqual(provider.remembered_ids.get(mail, '10.0.0.9'),
+                         fresh.remembered_ids.get(mail, '10.0.0.9'))
+        self.assertEqual(provider.remembered_ids.get_all_ids(
+            next(r for r in plan.existing.records if r._type == 'CNAME')),
+            [], "the deleted record is forgotten")
+
+    def test_relisting_is_estimated(self):
+        # Given
+        provider = self._provider()
+        plan = self._plan(provider)
+        before = dict(provider.metrics.calls)
+
+        # When
+        estimate = provider.estimate_api_calls(plan)
+        provider.max_api_calls = estimate['total'] - 1
+        with self.assertRaises(ApiCallBudgetExceeded):
+            provider._apply(plan)
+        provider.max_api_calls = estimate['total']
+        provider._apply(plan)
+
+        # Then
+        self.assertEqual(estimate['by_action'], {
+            'update_record': 2, 'create_record': 1, 'delete_record': 1,
+            'list_records': 1})
+        self.assertEqual(estimate['by_rtype'], {'A': 4, 'CNAME': 1})
+        made = {key: count - before.get(key, 0)
+                for key, count in provider.metrics.calls.items()}
+        self.assertEqual(sum(made.values()), estimate['total'])
+
+    def test_failed_apply_drops_state(self):
+        # Given
+        provider = self._provider()
+        plan = self._plan(provider)
+        provider._client_for('blodapels.in').provider.error_rate = 1
+
+        # When
+        with self.assertRaises(HTTPError):
+            provider._apply(plan)
+
+        # Then
+        self.assertIsNone(provider.zone_states.get(provider._account,
+                                                   'blodapels.in.'))
+
+    def test_failed_listing_drops_state(self):
+        # Given
+        provider = self._provider(
+            snapshot_cache=join(self.tmpdir.name, 'snapshots.db'))
+        plan = self._plan(provider)
+
+        # When
+        with patch.object(provider, '_list_slice',
+                          side_effect=HTTPError('down')):
+            provider._apply(plan)
+
+        # Then
+        self.assertIsNone(provider.zone_states.get(provider._account,
+                                                   'blodapels.in.'))
+        self.assertIsNone(provider.snapshots.get(provider._account,
+                                                 'blodapels.in.'))
+        provider.snapshots.close()
+
+    def test_listings_are_copied(self):
+        # Given
+        states = ZoneStateCache(300)
+        listing = [{'type': 'A', 'name': 'www', 'content': '10.0.0.1'}]
+
+        # When
+        states.put('account', 'blodapels.in.', listing)
+        listing[0]['content'] = '10.0.0.2'
+        got = states.get('account', 'blodapels.in.')
+        got[0]['content'] = '10.0.0.3'
+
+        # Then
+        self.assertEqual(states.get('account', 'blodapels.in.'),
+                         [{'type': 'A', 'name': 'www',
+                           'content': '10.0.0.1'}])
+
+
+class TestScopedPopulate(SimulatedZoneTestCase):
+
+    records = [
+        {'type': 'A', 'name': '@', 'content': '10.0.0.1'},
+        {'type': 'A', 'name': 'www', 'content': '10.0.0.2'},
+        {'type': 'A', 'name': 'other', 'content': '10.0.0.3'},
+        {'type': 'TXT', 'name': 'www', 'content': 'txt'},
+        {'type': 'MX', 'name': '@', 'content': '10 mx.example.com.'}]
+
+    def test_supports(self):
+        # Given
+        provider = self._provider(supports=['a', 'TXT'])
+        zone = Zone("blodapels.in.", [])
+
+        # When
+        provider.populate(zone)
+
+        # Then
+        self.assertEqual({(r.name, r._type) for r in zone.records},
+                         {('', 'A'), ('www', 'A'), ('other', 'A'),
+                          ('www', 'TXT')})
+        calls = provider.metrics.calls
+        self.assertEqual(calls[('list_records', 'blodapels.in', 'A')], 1)
+        self.assertEqual(calls[('list_records', 'blodapels.in', 'TXT')], 1)
+        self.assertEqual(calls[('list_records', 'blodapels.in', '')], 0)
+
+    def test_name_scopes(self):
+        # Given
+        provider = self._provider(name_scopes=['www', '@'],
+                                  supports=['A'])
+        zone = Zone("blodapels.in.", [])
+        desired = Zone("blodapels.in.", [])
+        for name in ('', 'www', 'other', 'new'):
+            desired.add_record(Record.new(desired, name, {
+                'ttl': 3600, 'type': 'A', 'value': '10.0.0.9'}))
+
+        # When
+        provider.populate(zone)
+        plan = provider.plan(desired)
+
+        # Then
+        self.assertEqual({(r.name, r._type) for r in zone.records},
+                         {('', 'A'), ('www', 'A')})
+        self.assertEqual(provider.metrics.calls[
+            ('list_records', 'blodapels.in', 'A')], 4)
+        self.assertEqual(sorted(c.record.name for c in plan.changes),
+                         ['', 'www'])
+
+    @patch('lexicon.providers.gandi.Provider')
+    def test_unfiltered_listing(self, provider_mock):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   supports=['A', 'MX', 'CNAME'],
+                                   name_scopes=['', 'www'])
+        provider_mock.return_value.list_records.side_effect = \
+            lambda *_: [dict(r) for r in LEXICON_DATA]
+        zone = Zone("blodapels.in.", [])
+
+        # When
+        provider.populate(zone)
+
+        # Then
+        self.assertEqual(zone.records, {OCTODNS_DATA[0], OCTODNS_DATA[1],
+                                        OCTODNS_DATA[4]})
+        self.assertIn(call('CNAME', 'www.blodapels.in.', None),
+                      provider_mock.return_value.list_records.mock_calls)
+        self.assertIn(call('MX', '@.blodapels.in.', None),
+                      provider_mock.return_value.list_records.mock_calls)
+
+
+class TestAsyncFrontEnd(SimulatedZoneTestCase):
+
+    records = [{'type': 'A', 'name': 'www', 'content': '10.0.0.1'}]
+
+    def test_populate_many_zones(self):
+        # Given
+        provider = self._provider()
+        zones = [Zone(name, []) for name in ("blodapels.in.", "other.in.")]
+
+        async def populate_all():
+            return await asyncio.gather(*(provider.async_populate(zone)
+                                          for zone in zones))
+
+        # When
+        exists = asyncio.run(populate_all())
+
+        # Then
+        self.assertEqual(exists, [True, True])
+        for zone in zones:
+            record, = zone.records
+            self.assertIs(record.zone, zone)
+            self.assertEqual(record.values, ['10.0.0.1'])
+            self.assertEqual(
+                provider.remembered_ids.get(record, '10.0.0.1'), '1')
+
+    def test_populate_timeout(self):
+        # Given
+        provider = self._provider(simulate={'latency': 0.2})
+        zone = Zone("blodapels.in.", [])
+
+        # When
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(provider.async_populate(zone, timeout=0.05))
+        provider._async_executor.shutdown(wait=True)
+
+        # Then
+        self.assertEqual(zone.records, set())
+
+    def test_apply(self):
+        # Given
+        provider = self._provider()
+        plan = self._plan(provider, a_records('www', 'a', 'b'))
+
+        # When
+        applied = asyncio.run(provider.async_apply(plan))
+
+        # Then
+        self.assertEqual(applied, 2)
+        self.assertEqual(len(provider._client_for('blodapels.in')
+                             .provider.list_records()), 3)
+
+    def test_apply_timeout(self):
+        # Given
+        provider = self._provider()
+        plan = self._plan(provider, a_records('www', 'a', 'b', 'c'))
+        provider._client_for('blodapels.in').provider.latency = 0.2
+
+        # When
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(provider.async_apply(plan, timeout=0.1))
+        provider._async_executor.shutdown(wait=True)
+
+        # Then
+        client = provider._client_for('blodapels.in')
+        self.assertEqual(client.provider.calls['create_record'], 1,
+                         "no change is started once cancelled")
+
+
+SYNC_CONFIG = """
+providers:
+  config:
+    class: octodns.provider.yaml.YamlProvider
+    directory: {directory}
+  lexicon:
+    class: octodns_lexicon.LexiconProvider
+    lexicon_config:
+      provider_name: gandi
+    simulate: {{}}
+  flaky:
+    class: octodns_lexicon.LexiconProvider
+    lexicon_config:
+      provider_name: gandi
+      gandi:
+        auth_token: other
+    simulate:
+      error_rate: 1
+zones:
+  a.in.:
+    sources: [config]
+    targets: [lexicon]
+  b.in.:
+    sources: [config]
+    targets: [lexicon]
+  c.in.:
+    sources: [config]
+    targets: [flaky]
+"""
+
+
+class TestSyncCommand(TestCase):
+
+    def setUp(self):
+        SimulatedProvider.reset()
+        self.tmpdir = TemporaryDirectory()
+        self.config_file = join(self.tmpdir.name, 'config.yaml')
+        self.report = join(self.tmpdir.name, 'report.json')
+        with open(self.config_file, 'w') as fh:
+            fh.write(SYNC_CONFIG.format(directory=self.tmpdir.name))
+        for zone_name in ('a.in.', 'b.in.', 'c.in.'):
+            with open(join(self.tmpdir.name, zone_name + 'yaml'), 'w') as fh:
+                fh.write("www:\n  type: A\n  value: 10.0.0.1\n")
+
+    def tearDown(self):
+        SimulatedProvider.reset()
+        self.tmpdir.cleanup()
+
+    def _main(self, *args):
+        argv = ['octodns-lexicon-sync', '--config-file', self.config_file,
+                '--report', self.report, '--quiet'] + list(args)
+        with patch('sys.argv', argv):
+            status = main()
+        with open(self.report) as fh:
+            return status, json.load(fh)
+
+    def test_sync(self):
+        # When
+        status, report = self._main('--doit', '--processes', '1')
+
+        # Then
+        self.assertEqual(status, 1)
+        self.assertEqual((report['zones'], report['failed'],
+                          report['applied']), (3, 1, 2))
+        self.assertEqual([(r['zone'], r['applied']) for r in
+                          report['results']],
+                         [('a.in.', 1), ('b.in.', 1), ('c.in.', 0)])
+        self.assertIn('HTTPError', report['results'][2]['error'])
+
+    def test_sync_processes(self):
+        # When
+        status, report = self._main('--processes', '2', 'a.in.', 'b.in.')
+
+        # Then
+        self.assertEqual(status, 0)
+        self.assertEqual([(r['zone'], r['error']) for r in
+                          report['results']],
+                         [('a.in.', None), ('b.in.', None)])
+
+    def test_unknown_zone(self):
+        # When
+        with patch('sys.stderr') as stderr, \
+                self.assertRaises(SystemExit) as raised:
+            self._main('a.in.', 'nope.in.')
+
+        # Then
+        self.assertEqual(raised.exception.code, 2)
+        self.assertIn('Requested zone(s) not found in config: nope.in.',
+                      ''.join(c[0][0] for c in stderr.write.call_args_list))
+        self.assertFalse(exists(self.report))
+
+    def test_broken_pool(self):
+        # Given
+        class BrokenPool:
+
+            def __init__(self):
+                self.submitted = 0
+
+            def submit(self, func, zone_name, *args):
+                self.submitted += 1
+                if self.submitted > 1:
+                    raise BrokenProcessPool('pool is broken')
+                future = Future()
+                future.set_exception(BrokenProcessPool('worker died'))
+                return future
+
+        zone_accounts = {'a.in.': {'x'}, 'b.in.': {'x'}, 'c.in.': set()}
+
+        # When
+        results = _sync_fleet(BrokenPool(), zone_accounts, 1, 1, True, False)
+
+        # Then
+        self.assertEqual([(r['zone'], r['applied'], r['error'])
+                          for r in results],
+                         [('a.in.', 0, 'BrokenProcessPool: worker died'),
+                          ('b.in.', 0, 'BrokenProcessPool: pool is broken'),
+                          ('c.in.', 0, 'BrokenProcessPool: pool is broken')])
+
+    def test_account_concurrency(self):
+        # Given
+        lock = Lock()
+        in_flight = defaultdict(int)
+        peaks = defaultdict(int)
+        zone_accounts = {'x{}.in.'.format(i): {'x'} for i in range(6)}
+        zone_accounts.update({'y0.in.': {'x', 'y'}, 'y1.in.': {'y'},
+                              'z.in.': set()})
+
+        def sync_zone(zone_name, dry_run, force):
+            with lock:
+                for account in zone_accounts[zone_name]:
+                    in_flight[account] += 1
+                    peaks[account] = max(peaks[account], in_flight[account])
+            time.sleep(0.02)
+            with lock:
+                for account in zone_accounts[zone_name]:
+                    in_flight[account] -= 1
+            return {'zone': zone_name}
+
+        # When
+        with patch.object(octodns_lexicon, '_sync_zone', sync_zone), \
+                ThreadPoolExecutor(max_workers=8) as executor:
+            results = _sync_fleet(executor, zone_accounts, 8, 2, True,
+                                  False)
+
+        # Then
+        self.assertEqual([r['zone'] for r in results], sorted(zone_accounts))
+        self.assertEqual(peaks['x'], 2)
+        self.assertLessEqual(peaks['y'], 2)
+
+
+def gandi_response(session, method, url, **kwargs):
+    response = Mock(status_code=200, headers={})
+    if url.endswith('/records'):
+        response.json.return_value = [
+            {'rrset_type': 'A', 'rrset_name': 'www', 'rrset_ttl': 300,
+             'rrset_values': ['10.0.0.1']}]
+    else:
+        response.json.return_value = {}
+    return response
+
+
+class TestHttpSession(TestCase):
+
+    @patch.object(Session, 'request', autospec=True,
+                  side_effect=gandi_response)
+    def test_shared_by_zones(self, request_mock):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config)
+        zones = [Zone("blodapels.in.", []), Zone("other.in.", [])]
+
+        # When
+        for zone in zones:
+            provider.populate(zone)
+
+        # Then
+        self.assertEqual([len(zone.records) for zone in zones], [1, 1])
+        self.assertEqual(request_mock.call_count, 4)
+        for args, kwargs in request_mock.call_args_list:
+            self.assertIs(args[0], provider.http_session.session)
+            self.assertEqual(kwargs['timeout'], 60)
+
+    @patch.object(Session, 'request', autospec=True,
+                  side_effect=gandi_response)
+    def test_populate_twice(self, request_mock):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   http_cache=True)
+
+        # When
+        provider.populate(Zone("blodapels.in.", []))
+        provider._list_zone("blodapels.in.")
+
+        # Then
+        self.assertEqual(request_mock.call_count, 2,
+                         "the second listing is served from the cache")
+        self.assertEqual(provider.http_session.hits, 1)
+
+    def test_cache(self):
+        # Given
+        session = PooledHttpSession(cache=True)
+        tagged = Mock(status_code=200, headers={'ETag': '"1"'})
+        dated = Mock(status_code=200, headers={
+            'Last-Modified': 'Sat, 17 Oct 2026 10:00:00 GMT'})
+        plain = Mock(status_code=200, headers={})
+        responses = {'/tagged': [tagged, Mock(status_code=304)],
+                     '/dated': [dated, Mock(status_code=304)],
+                     '/plain': [plain] + [Mock(status_code=200)
+                                          for _ in range(3)]}
+
+        def send(method, url, **kwargs):
+            return responses[url].pop(0)
+
+        # When
+        with patch.object(session, '_send', side_effect=send) as send_mock, \
+                session.caching():
+            served = [session.request('GET', url) for url in
+                      ('/tagged', '/dated', '/plain') * 2]
+            session.request('HEAD', '/plain')
+            session.request('POST', '/plain', data='x')
+            served.append(session.request('GET', '/plain'))
+
+        # Then
+        self.assertEqual(served[:6], [tagged, dated, plain] * 2)
+        self.assertIsNot(served[6], plain, "posts empty the cache")
+        self.assertEqual(send_mock.call_args_list[3][1]['headers'],
+                         {'If-None-Match': '"1"'})
+        self.assertEqual(send_mock.call_args_list[4][1]['headers'],
+                         {'If-Modified-Since':
+                          'Sat, 17 Oct 2026 10:00:00 GMT'})
+        self.assertEqual((session.hits, session.revalidations), (1, 2))
+
+    def test_mutations_empty_cache(self):
+        # Given
+        session = PooledHttpSession(cache=True)
+        session.cache['key'] = Mock()
+        client = CachedLexiconClient(
+            Mock(), OnTheFlyLexiconConfigSource('blodapels.in'),
+            http_session=session)
+
+        # When
+        client.call('list_records', None)
+        cached = len(session.cache)
+        client.call('delete_record', None, identifier='1')
+
+        # Then
+        self.assertEqual((cached, len(session.cache)), (1, 0))
+
+    def test_polled_during_mutation(self):
+        # Given
+        session = PooledHttpSession(cache=True)
+        module = Mock(requests=requests)
+
+        class Provider:
+            __module__ = 'polling_provider'
+
+            def list_records(self, *args):
+                return module.requests.get('/records').json()
+
+            def create_record(self, *args):
+                # posts a job, then polls it until it is done
+                module.requests.post('/jobs')
+                while module.requests.get('/jobs/1').json() == 'RUNNING':
+                    pass
+                return True
+
+        states = ['RUNNING', 'RUNNING', 'DONE']
+
+        def send(method, url, **kwargs):
+            response = Mock(status_code=200, headers={})
+            if url == '/jobs/1':
+                response.json.return_value = states.pop(0)
+            return response
+
+        # When
+        with patch.dict('sys.modules', polling_provider=module), \
+                patch.object(session, '_send', side_effect=send) as send_mock:
+            client = CachedLexiconClient(
+                Mock(provider=Provider()),
+                OnTheFlyLexiconConfigSource('blodapels.in'),
+                http_session=session)
+            client.call('list_records', None)
+            client.call('list_records', None)
+            created = client.call('create_record', None, 'A', 'www',
+                                  '10.0.0.1')
+
+        # Then
+        self.assertTrue(created)
+        self.assertEqual(states, [])
+        self.assertEqual([args[:2] for args, _ in send_mock.call_args_list],
+                         [('GET', '/records'), ('POST', '/jobs')] +
+                         [('GET', '/jobs/1')] * 3)
+        self.assertEqual(session.hits, 1)
+
+    @patch('requests.request',
+           side_effect=lambda *args, **kwargs: gandi_response(
+               None, *args, **kwargs))
+    def test_disabled(self, request_mock):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   http_pool_size=0)
+        zone = Zone("blodapels.in.", [])
+
+        # When
+        provider.populate(zone)
+
+        # Then
+        self.assertIsNone(provider.http_session)
+        self.assertEqual(len(zone.records), 1)
+        self.assertEqual(request_mock.call_count, 2)
+
+    @patch.object(Session, 'request', autospec=True)
+    def test_session_options(self, request_mock):
+        # Given
+        session = PooledHttpSession(pool_size=2, timeout=5,
+                                    compression=False)
+
+        # When
+        session.request('GET', 'https://example.com/', timeout=1)
+
+        # Then
+        self.assertEqual(request_mock.call_args[1]['timeout'], 1)
+        self.assertEqual(session.session.headers['Accept-Encoding'],
+                         'identity')
+        self.assertEqual(session.session.get_adapter('https://example.com/')
+                         ._pool_maxsize, 2)
+
+    def test_routed_requests(self):
+        # Given
+        module = Mock(requests=requests)
+        provider = type('Provider', (), {'__module__': 'routed_provider'})()
+        session = Mock()
+
+        # When
+        with patch.dict('sys.modules', routed_provider=module):
+            _route_requests(provider)
+            with _using_http_session(session):
+                module.requests.get('/get', {'q': 1})
+                module.requests.head('/head')
+                module.requests.post('/post', 'data', timeout=3)
+            routed = module.requests
+            with patch.object(requests, 'delete') as delete_mock:
+                routed.delete('/delete')
+
+        # Then
+        self.assertIsNot(routed, requests)
+        self.assertIs(routed.exceptions, requests.exceptions)
+        self.assertEqual(session.request.call_args_list, [
+            call('GET', '/get', params={'q': 1}),
+            call('HEAD', '/head', allow_redirects=False),
+            call('POST', '/post', data='data', timeout=3)])
+        delete_mock.assert_called_once_with('/delete')
+
+
+class TestApplyJournal(SimulatedZoneTestCase):
+
+    desired = a_records('a', 'b', 'c')
+
+    def options(self):
+        return {'journal_dir': self.tmpdir.name}
+
+    @staticmethod
+    def _crash_after(provider, count):
+        execute = provider._execute
+        executed = []
+
+        def crashing(client, operation):
+            execute(client, operation)
+            executed.append(operation)
+            if len(executed) == count:
+                raise RuntimeError('crash')
+
+        return patch.object(provider, '_execute', side_effect=crashing)
+
+    @staticmethod
+    def _calls(provider):
+        return provider._client_for('blodapels.in').provider.calls
+
+    def test_resume(self):
+        # Given
+        provider = self._provider()
+        plan = self._plan(provider)
+
+        # When
+        with self._crash_after(provider, 2), \
+                self.assertRaises(RuntimeError):
+            provider._apply(plan)
+        journal, = [join(self.tmpdir.name, f)
+                    for f in listdir(self.tmpdir.name)]
+        with open(journal) as fh:
+            events = [json.loads(line)['event'] for line in fh]
+        provider._apply(plan)
+
+        # Then
+        self.assertEqual(events, ['plan', 'started', 'done', 'started'])
+        self.assertEqual(self._calls(provider)['create_record'], 3,
+                         "no record is created twice")
+        self.assertEqual(self._calls(provider)['list_records'], 2,
+                         "the listing and one check of the started one")
+        self.assertFalse(exists(journal))
+
+    def test_resume_started_ttl_update(self):
+        # Given
+        provider = self._provider(bulk_operations=False)
+        provider._apply(self._plan(provider))
+        existing = Zone("blodapels.in.", [])
+        provider.populate(existing)
+        desired = Zone("blodapels.in.", [])
+        for record in existing.records:
+            desired.add_record(Record.new(desired, record.name, {
+                'ttl': 600 if record.name == 'a' else record.ttl,
+                'type': 'A', 'values': record.values}))
+        plan = Plan(existing, desired, existing.changes(desired, provider),
+                    True)
+
+        # When
+        with patch.object(provider, '_execute',
+                          side_effect=RuntimeError('crash')), \
+                self.assertRaises(RuntimeError):
+            provider._apply(plan)
+        provider._apply(plan)
+        applied = Zone("blodapels.in.", [])
+        self._provider().populate(applied)
+
+        # Then
+        self.assertEqual(self._calls(provider)['update_record'], 1,
+                         "the started update is not taken as applied")
+        self.assertEqual({r.name: r.ttl for r in applied.records},
+                         {'a': 600, 'b': 3600, 'c': 3600})
+
+    def test_resume_budget(self):
+        # Given
+        provider = self._provider()
+        plan = self._plan(provider)
+        with self._crash_after(provider, 2), \
+                self.assertRaises(RuntimeError):
+            provider._apply(plan)
+
+        # When
+        provider.max_api_calls = 2
+        provider._apply(plan)
+
+        # Then
+        self.assertEqual(self._calls(provider)['create_record'], 3)
+
+    def test_budget_exceeded_leaves_no_journal(self):
+        # Given
+        provider = self._provider(max_api_calls=2)
+
+        # When
+        with self.assertRaises(ApiCallBudgetExceeded):
+            provider._apply(self._plan(provider))
+
+        # Then
+        self.assertEqual(listdir(self.tmpdir.name), [])
+
+    def test_other_plan(self):
+        # Given
+        provider = self._provider()
+        plan = self._plan(provider)
+        with self._crash_after(provider, 1), \
+                self.assertRaises(RuntimeError):
+            provider._apply(plan)
+
+        # When
+        provider._apply(self._plan(provider))
+
+        # Then
+        self.assertEqual(self._calls(provider)['create_record'], 3)
+
+    def test_reconcile_snapshot(self):
+        # Given
+        snapshots = join(self.tmpdir.name, 'snapshots.db')
+        provider = self._provider(snapshot_cache=snapshots)
+        plan = self._plan(provider)
+        with self._crash_after(provider, 2), \
+                self.assertRaises(RuntimeError):
+            provider._apply(plan)
+
+        # When
+        later = self._provider(snapshot_cache=snapshots)
+        zone = Zone("blodapels.in.", [])
+        later.populate(zone)
+        again = Zone("blodapels.in.", [])
+        later.populate(again)
+
+        # Then
+        self.assertEqual(sorted(r.name for r in zone.records), ['a', 'b'])
+        self.assertEqual(again.records, zone.records)
+        calls = later.metrics.calls
+        self.assertEqual(calls[('list_records', 'blodapels.in', 'A')], 2,
+                         "only the rrsets touched are listed")
+        self.assertEqual(calls[('list_records', 'blodapels.in', '')], 0)
+
+    def test_torn_entry(self):
+        # Given
+        journal = ApplyJournal(join(self.tmpdir.name, 'torn.journal'))
+        with open(journal.path, 'w') as fh:
+            fh.write('{"event": "plan", "fingerprint": "x"}\n{"event": "st')
+
+        # Then
+        self.assertEqual(journal.entries(),
+                         [{'event': 'plan', 'fingerprint': 'x'}])
+        self.assertEqual(journal.touched(), set())
+        journal.remove()
+        journal.remove()
+        self.assertEqual(journal.entries(), [])
@@ -26,6 +26,11 @@ setuptools.setup(
          "License :: OSI Approved :: MIT License",
          'Programming Language :: Python :: 3',
     ],
+    entry_points={
+        'console_scripts': [
+            'octodns-lexicon-sync = octodns_lexicon:main',
+        ],
+    },
     tests_require=["pytest"],
     install_requires=[
         'octodns>=0.9.21',